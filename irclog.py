@@ -1,52 +1,427 @@
 #!/usr/bin/python3
 
-def format_logline(line, channel, identity):
-    if len(line.tokens) > 2:
-        if line.tokens[1] == "JOIN":
-            if identity == "":
-                identity = line.tokens[0][len(line.sender) + 2:]
-            return "-> " + line.sender + " (" + identity + ") joins"
-        elif line.tokens[1] == "PART":
-            msg = ""
-            if len(line.tokens) > 3 and line.tokens[3][0] == ":":
-                msg = " (" + str.join(" ", line.tokens[3:])[1:] + ")"
-            return "<- " + line.sender + " parts" + msg 
-        elif line.tokens[1] == "QUIT":
-            msg = ""
-            if len(line.tokens) > 2 and line.tokens[2][0] == ":":
-                msg = " (" + str.join(" ", line.tokens[2:])[1:] + ")"
-            return "<- " + line.sender + " quits server" + msg
-        elif line.tokens[1] == "NICK":
-            return "-- " + line.sender + " changes their name to " + line.receiver 
-        elif len(line.tokens) > 3:
-            if line.tokens[1] in {"PRIVMSG", "NOTICE"}:
-                if line.tokens[3] == ":\u0001ACTION" and \
-                        line.tokens[-1][-1] == "\u0001":
-                    msg = str.join(" ", line.tokens[4:])[:-1]
-                    if line.receiver == channel:
-                        return " * " + line.sender + " " + msg 
-                else:
-                    msg = str.join(" ", line.tokens[3:])[1:]
-                    if line.receiver == channel:
-                        return "   <" + line.sender + "> " + msg 
-            elif line.tokens[1] == "TOPIC":
-                msg = str.join(" ", line.tokens[3:])[1:]
-                if line.receiver == channel:
-                    return "-- " + line.sender + " sets topic to: " + msg 
-            elif line.tokens[1] == "KICK":
-                operands = line.tokens[2:]
-                pairs = {}
-                for i in range(len(operands)):
-                    if 0 == i % 2:
-                        if operands[i][0] == ":":
-                            msg = " (" + str.join(" ", operands[i:])[1:] + ")"
-                            break
-                    else:
-                        pairs[operands[i - 1]] = operands[i]
-                if channel in pairs:
-                    return "-- " + line.sender + " kicks " + pairs[channel] + msg
-            elif line.tokens[1] == "MODE":
-                msg = str.join(" ", line.tokens[3:])
-                if line.receiver == channel:
-                    return "-- " + line.sender + " sets channel mode " + msg 
+import atexit
+import datetime
+import gzip
+import io
+import os
+import shutil
+import threading
+import time
+import plommetrics
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+LOG_BUFFER_SIZE = 64 * 1024
+LOG_FLUSH_INTERVAL = 5
+LOG_MAINTENANCE_INTERVAL = 60 * 60
+
+
+def open_logfile(path):
+    # Open a plain, gzip'd or zstd'd log file for reading as text.
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    elif path.endswith(".zst"):
+        if zstandard == None:
+            raise ValueError("zstandard module needed to read " + path)
+        f = open(path, "rb")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f,
+                                closefd=True))
+    return open(path, "r")
+
+
+def logfile_day(filename):
+    # Day a log file name stands for, or None if it's no day log file.
+    day = filename[:10]
+    if len(day) == 10 and day[4] == day[7] == "-" and \
+            day.replace("-", "").isdigit() and \
+            filename[10:] in {".txt"} | \
+            {".txt" + suffix for suffix in COMPRESSION_SUFFIXES.values()}:
+        return day
     return None
+
+
+def compress_logfile(path, method):
+    target = path + COMPRESSION_SUFFIXES[method]
+    tmp_target = target + ".tmp"
+    source = open(path, "rb")
+    if method == "gzip":
+        out = gzip.open(tmp_target, "wb")
+        shutil.copyfileobj(source, out)
+        out.close()
+    else:
+        out = open(tmp_target, "wb")
+        zstandard.ZstdCompressor().copy_stream(source, out)
+        out.close()
+    source.close()
+    stat = os.stat(path)
+    os.utime(tmp_target, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_target, target)
+    os.remove(path)
+    return target
+
+
+_RFC1459_LOWER = str.maketrans("[]\\~", "{}|^")
+_TAG_ESCAPES = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+
+def casefold(nick):
+    # Nicks and channel names compare case-insensitively, with "[]\\~" the
+    # upper case of "{}|^".
+    return nick.lower().translate(_RFC1459_LOWER)
+
+
+class Line:
+
+    # Split off IRCv3 tags, prefix and command up front; params, tags and the
+    # prefix's nick/user/host only get picked apart when first asked for.
+    __slots__ = ("line", "tag_string", "prefix", "command", "param_string",
+                 "_params", "_tags", "_nick", "_user", "_host")
+
+    def __init__(self, line):
+        self.line = line
+        self.tag_string = None
+        self.prefix = None
+        if line[:1] == "@":
+            self.tag_string, _, line = line[1:].partition(" ")
+            line = line.lstrip(" ")
+        if line[:1] == ":":
+            self.prefix, _, line = line[1:].partition(" ")
+            line = line.lstrip(" ")
+        self.command, _, self.param_string = line.partition(" ")
+        self._params = None
+        self._tags = None
+        self._nick = None
+        self._user = None
+        self._host = None
+
+    @property
+    def params(self):
+        if self._params == None:
+            if self.param_string[:1] == ":":
+                params = [self.param_string[1:]]
+            else:
+                middle, colon, trailing = self.param_string.partition(" :")
+                params = middle.split()
+                if colon:
+                    params += [trailing]
+            self._params = params
+        return self._params
+
+    @property
+    def tags(self):
+        if self._tags == None:
+            tags = {}
+            if self.tag_string:
+                for tag in self.tag_string.split(";"):
+                    key, _, value = tag.partition("=")
+                    if "\\" in value:
+                        unescaped = ""
+                        i = value.find("\\")
+                        while i >= 0:
+                            unescaped += value[:i] + \
+                                _TAG_ESCAPES.get(value[i + 1:i + 2],
+                                                 value[i + 1:i + 2])
+                            value = value[i + 2:]
+                            i = value.find("\\")
+                        value = unescaped + value
+                    tags[key] = value
+            self._tags = tags
+        return self._tags
+
+    def _split_prefix(self):
+        prefix = self.prefix or ""
+        nick, _, host = prefix.partition("@")
+        nick, _, user = nick.partition("!")
+        if self._nick == None:
+            self._nick = nick
+        self._user = user
+        self._host = host
+
+    @property
+    def nick(self):
+        if self._nick == None:
+            self._split_prefix()
+        return self._nick
+
+    @nick.setter
+    def nick(self, nick):
+        self._nick = nick
+
+    sender = nick
+
+    @property
+    def user(self):
+        if self._user == None:
+            self._split_prefix()
+        return self._user
+
+    @property
+    def host(self):
+        if self._host == None:
+            self._split_prefix()
+        return self._host
+
+    @property
+    def identity(self):
+        if self.prefix == None or "!" not in self.prefix:
+            return ""
+        return self.user + "@" + self.host
+
+    @property
+    def receiver(self):
+        params = self.params
+        if len(params) == 0:
+            return ""
+        receiver = params[0]
+        for separator in "!@":
+            i = receiver.find(separator)
+            if i >= 0:
+                receiver = receiver[:i]
+        return receiver
+
+
+def _reason(text):
+    if text == "":
+        return ""
+    return " (" + text + ")"
+
+
+def _join_event(line, channel, identity):
+    if identity == "":
+        identity = line.identity
+    return "join", "", identity
+
+
+def _part_event(line, channel, identity):
+    params = line.params
+    return "part", "", params[1] if len(params) > 1 else ""
+
+
+def _quit_event(line, channel, identity):
+    params = line.params
+    return "quit", "", params[0] if len(params) > 0 else ""
+
+
+def _nick_event(line, channel, identity):
+    return "nick", line.receiver, ""
+
+
+def _message_event(line, channel, identity):
+    params = line.params
+    if len(params) < 2 or casefold(line.receiver) != casefold(channel):
+        return None
+    msg = params[1]
+    if msg[:8] == "\u0001ACTION " and msg[-1:] == "\u0001":
+        return "action", "", msg[8:-1]
+    return line.command.lower(), "", msg
+
+
+def _topic_event(line, channel, identity):
+    params = line.params
+    if len(params) < 2 or casefold(line.receiver) != casefold(channel):
+        return None
+    return "topic", "", params[1]
+
+
+def _kick_event(line, channel, identity):
+    params = line.params
+    if len(params) < 2:
+        return None
+    channels = casefold(params[0]).split(",")
+    channel = casefold(channel)
+    if channel not in channels:
+        return None
+    users = params[1].split(",")
+    user = users[min(channels.index(channel), len(users) - 1)]
+    return "kick", user, params[2] if len(params) > 2 else ""
+
+
+def _mode_event(line, channel, identity):
+    params = line.params
+    if len(params) < 2 or casefold(line.receiver) != casefold(channel):
+        return None
+    return "mode", "", str.join(" ", params[1:])
+
+
+_EVENTS = {
+    "JOIN": _join_event,
+    "PART": _part_event,
+    "QUIT": _quit_event,
+    "NICK": _nick_event,
+    "PRIVMSG": _message_event,
+    "NOTICE": _message_event,
+    "TOPIC": _topic_event,
+    "KICK": _kick_event,
+    "MODE": _mode_event,
+}
+
+_FORMATS = {
+    "join": lambda sender, target, text:
+        "-> " + sender + " (" + text + ") joins",
+    "part": lambda sender, target, text:
+        "<- " + sender + " parts" + _reason(text),
+    "quit": lambda sender, target, text:
+        "<- " + sender + " quits server" + _reason(text),
+    "nick": lambda sender, target, text:
+        "-- " + sender + " changes their name to " + target,
+    "privmsg": lambda sender, target, text: "   <" + sender + "> " + text,
+    "notice": lambda sender, target, text: "   <" + sender + "> " + text,
+    "action": lambda sender, target, text: " * " + sender + " " + text,
+    "topic": lambda sender, target, text:
+        "-- " + sender + " sets topic to: " + text,
+    "kick": lambda sender, target, text:
+        "-- " + sender + " kicks " + target + _reason(text),
+    "mode": lambda sender, target, text:
+        "-- " + sender + " sets channel mode " + text,
+}
+
+
+def logline_event(line, channel, identity):
+    # (event, target, text) of a line as seen from channel, or None if it's
+    # nothing to log there.
+    event = _EVENTS.get(line.command)
+    if event == None:
+        return None
+    return event(line, channel, identity)
+
+
+def format_event(sender, event, target, text):
+    return _FORMATS[event](sender, target, text)
+
+
+def format_logline(line, channel, identity):
+    event = logline_event(line, channel, identity)
+    if event == None:
+        return None
+    return format_event(line.sender, *event)
+
+
+class Log:
+
+    def __init__(self, chandir, nickname, username, channel, rmlogs,
+                 fsync="never", compress="none", report=print,
+                 schedule=None):
+        self.nickname = nickname
+        self.username = username
+        self.channel = channel
+        self.chandir = chandir
+        self.rmlogcycle = rmlogs
+        self.fsync = fsync
+        self.compress = compress
+        self.report = report
+        self.schedule = schedule
+        self.flush_timer = None
+        self.next_maintenance = 0
+        self.maintenance = None
+        self.rawlogdir = chandir + "raw_logs/"
+        self.logdir = chandir + "logs/"
+        if not os.path.exists(self.logdir):
+            os.makedirs(self.logdir)
+        if not os.path.exists(self.rawlogdir):
+            os.makedirs(self.rawlogdir)
+        self.day = None
+        self.files = {}
+        self.last_flush = time.time()
+        atexit.register(self.close)
+
+    def _write(self, logdir, day, text):
+
+        # Keep the current day's files open, switch over when the day changes.
+        if day != self.day:
+            self.close_files()
+            self.day = day
+            self.next_maintenance = 0
+        f = self.files.get(logdir)
+        if f is None:
+            f = open(logdir + day + ".txt", "a", buffering=LOG_BUFFER_SIZE)
+            self.files[logdir] = f
+        f.write(text)
+
+        # Given a schedule(delay, callback) such as an asyncio loop's
+        # call_later, flush no later than LOG_FLUSH_INTERVAL after the
+        # first line written since the last flush.
+        if self.schedule != None and self.flush_timer == None:
+            self.flush_timer = self.schedule(LOG_FLUSH_INTERVAL, self.flush)
+
+    def flush(self):
+        if self.flush_timer != None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        for f in self.files.values():
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+        self.last_flush = time.time()
+
+    def flush_if_due(self):
+        if self.fsync == "always" or \
+                self.last_flush + LOG_FLUSH_INTERVAL < time.time():
+            self.flush()
+
+    def close_files(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def close(self):
+        self.close_files()
+        atexit.unregister(self.close)
+
+    @plommetrics.timed("log")
+    def log(self, line, sent=False):
+        identity = ""
+        separator = " > "
+        if sent:
+            separator = " < "
+            line.sender = self.nickname
+            identity = self.username + "@localhost"
+        now = datetime.datetime.utcnow()
+        stamp = now.strftime("%Y-%m-%d %H:%M:%S UTC")
+        day = stamp[:10]
+        self._write(self.rawlogdir, day, stamp + separator + line.line + "\n")
+        to_log = format_logline(line, self.channel, identity)
+        if to_log != None:
+            self._write(self.logdir, day, stamp + " " + to_log + "\n")
+        self.flush_if_due()
+
+    def rmlogs(self):
+
+        # Run at most hourly or on day change, in a thread of its own.
+        if time.time() < self.next_maintenance or \
+                (self.maintenance != None and self.maintenance.is_alive()):
+            return
+        self.next_maintenance = time.time() + LOG_MAINTENANCE_INTERVAL
+        if self.rmlogcycle > 0 or self.compress != "none":
+            self.maintenance = threading.Thread(target=self._maintain,
+                                                args=(self.day,), daemon=True)
+            self.maintenance.start()
+
+    def _maintain(self, today):
+        for logdir in [self.logdir, self.rawlogdir]:
+            for f in os.listdir(logdir):
+                day = logfile_day(f)
+                f = os.path.join(logdir, f)
+                if day == None or not os.path.isfile(f):
+                    continue
+                try:
+                    # The current day's files are kept open for writing.
+                    if self.rmlogcycle > 0 and day != today and \
+                            os.stat(f).st_mtime < time.time() - self.rmlogcycle:
+                        os.remove(f)
+                    elif self.compress != "none" and f.endswith(".txt") and \
+                            today != None and day < today:
+                        compress_logfile(f, self.compress)
+                except OSError as err:
+                    self.report("LOG MAINTENANCE FAILED FOR " + f + ": "
+                                + str(err))
+
+    def separator_line(self):
+        now = datetime.datetime.utcnow()
+        self._write(self.logdir, now.strftime("%Y-%m-%d"),
+                    "-----------------------\n")
+        self.flush_if_due()
@@ -0,0 +1,387 @@
+#!/usr/bin/python3
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import irclog
+import plommarkov
+import plomsearch
+
+# Defaults, may be overwritten by command line arguments.
+SEED = 0
+MIN_TIME = 1.0
+SIZES = [1000, 10000, 100000]
+SELECT_LENGTHS = [1, 2, 3]
+RAW_LINES = 10000
+MARKOV_LINES = 20000
+GENERATE_TOKENS = 40
+REGRESSION_THRESHOLD = 10
+
+
+def make_words(rng, n):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < n:
+        words.add(str.join("", [rng.choice(letters)
+                                for i in range(rng.randint(3, 9))]))
+    return sorted(words, key=lambda word: (len(word), word))
+
+
+def make_sentences(rng, words, n):
+    # Word frequencies roughly Zipf-distributed, as in real chat.
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    sentences = []
+    for i in range(n):
+        sentence = rng.choices(words, weights, k=rng.randint(4, 15))
+        if rng.random() < 0.05:
+            sentence += ["https://example.org/" + rng.choice(words)]
+        sentences += [str.join(" ", sentence)]
+    return sentences
+
+
+def make_raw_lines(rng, words, n):
+    nicks = words[100:150]
+    sentences = make_sentences(rng, words, n)
+    lines = []
+    for i in range(n):
+        nick = rng.choice(nicks)
+        prefix = ":" + nick + "!~" + nick + "@host-" + str(i % 97) + \
+            ".example.org "
+        kind = rng.random()
+        if kind < 0.75:
+            lines += [prefix + "PRIVMSG #bench :" + sentences[i]]
+        elif kind < 0.8:
+            lines += ["@time=2020-01-01T00:00:00.000Z;account=" + nick + " "
+                      + prefix + "PRIVMSG #bench :" + sentences[i]]
+        elif kind < 0.83:
+            lines += [prefix + "PRIVMSG #bench :\u0001ACTION " + sentences[i]
+                      + "\u0001"]
+        elif kind < 0.88:
+            lines += [prefix + "JOIN #bench"]
+        elif kind < 0.92:
+            lines += [prefix + "PART #bench :" + sentences[i]]
+        elif kind < 0.95:
+            lines += [prefix + "QUIT :" + sentences[i]]
+        elif kind < 0.97:
+            lines += [prefix + "NICK :" + rng.choice(nicks)]
+        elif kind < 0.98:
+            lines += [prefix + "KICK #bench " + rng.choice(nicks) + " :"
+                      + sentences[i]]
+        elif kind < 0.99:
+            lines += [prefix + "MODE #bench +o " + rng.choice(nicks)]
+        else:
+            lines += ["PING :irc.example.org"]
+    return lines
+
+
+def read_raw_lines(path):
+    # Lines sent or received as recorded in a raw_logs/ day file.
+    f = irclog.open_logfile(path)
+    lines = [line[26:].rstrip("\n") for line in f if len(line) > 27]
+    f.close()
+    return lines
+
+
+def benchmarks(opts, tmpdir):
+
+    # Pairs of name and setup function; the latter returns a function that
+    # runs some operations and returns how many.
+    rng = random.Random(opts.seed)
+    words = make_words(rng, 2000)
+    queries = [words[0], words[1] + " AND " + words[2],
+               words[0] + " AND (" + words[3] + " OR NOT " + words[1] + ")",
+               '"' + words[0] + " " + words[1] + '"', "NOT " + words[4],
+               words[20] + " OR " + words[30] + " OR " + words[40]]
+    rare_queries = [words[1500], words[800] + " AND " + words[900],
+                    words[1200] + " OR " + words[1300],
+                    words[600] + " AND NOT " + words[0],
+                    '"' + words[700] + " " + words[701] + '"']
+    corpora = {}
+
+    def corpus(size):
+        if size not in corpora:
+            corpora[size] = make_sentences(random.Random(opts.seed + size),
+                                           words, size)
+        return corpora[size]
+
+    def search_parse():
+        def run():
+            for query in queries:
+                plomsearch.compileQuery.__wrapped__(query)
+            return len(queries)
+        return run
+
+    def search_index(size):
+        def setup():
+            lines = corpus(size)
+
+            def run():
+                plomsearch.SearchIndex(lines)
+                return 1
+            return run
+        return setup
+
+    def search(size, indexed, query_list):
+        def setup():
+            lines = corpus(size)
+            index = plomsearch.SearchIndex(lines) if indexed else None
+
+            def run():
+                for query in query_list:
+                    plomsearch.search(query, lines, index)
+                return len(query_list)
+            return run
+        return setup
+
+    def search_batch(size, query_list):
+        def setup():
+            batch_corpus = plomsearch.BatchCorpus(corpus(size))
+            batch_corpus.text()
+
+            def run():
+                for query in query_list:
+                    plomsearch.searchBatch(query, batch_corpus)
+                return len(query_list)
+            return run
+        return setup
+
+    raw_lines = []
+
+    def get_raw_lines():
+        if len(raw_lines) == 0:
+            if opts.raw_log != None:
+                raw_lines.extend(read_raw_lines(opts.raw_log))
+            else:
+                raw_lines.extend(make_raw_lines(random.Random(opts.seed),
+                                                words, RAW_LINES))
+        return raw_lines
+
+    def line_parse():
+        lines = get_raw_lines()
+
+        def run():
+            for line in lines:
+                line = irclog.Line(line)
+                line.command
+                line.params
+                line.sender
+            return len(lines)
+        return run
+
+    def format_logline():
+        lines = [irclog.Line(line) for line in get_raw_lines()]
+
+        def run():
+            for line in lines:
+                irclog.format_logline(line, "#bench", "")
+            return len(lines)
+        return run
+
+    def log_log():
+        lines = [irclog.Line(line) for line in get_raw_lines()]
+        chandir = tempfile.mkdtemp(dir=tmpdir) + "/"
+        log = irclog.Log(chandir, "plombench", "plombench", "#bench", 0)
+
+        def run():
+            for line in lines:
+                log.log(line)
+            log.flush()
+            return len(lines)
+        return run
+
+    markov_path = os.path.join(tmpdir, "markovfeed")
+
+    def write_markov_feed():
+        if not os.path.exists(markov_path):
+            f = open(markov_path, "w")
+            for sentence in make_sentences(random.Random(opts.seed), words,
+                                           MARKOV_LINES):
+                f.write(sentence + "\n")
+            f.close()
+
+    def markov_build():
+        write_markov_feed()
+
+        def run():
+
+            # Build from the feed alone: without a snapshot, and without
+            # letting the model write one.
+            if os.path.exists(markov_path + plommarkov.SNAPSHOT_SUFFIX):
+                os.remove(markov_path + plommarkov.SNAPSHOT_SUFFIX)
+            limit = plommarkov.SNAPSHOT_JOURNAL_LIMIT
+            plommarkov.SNAPSHOT_JOURNAL_LIMIT = os.path.getsize(markov_path)
+            try:
+                model = plommarkov.MarkovModel(markov_path)
+                for order in plommarkov.SNAPSHOT_ORDERS:
+                    model.table(order)
+            finally:
+                plommarkov.SNAPSHOT_JOURNAL_LIMIT = limit
+            return 1
+        return run
+
+    def markov_snapshot_load():
+        write_markov_feed()
+        model = plommarkov.MarkovModel(markov_path)
+        model.save_snapshot()
+
+        def run():
+            plommarkov.MarkovModel(markov_path)
+            return 1
+        return run
+
+    def markov_generate(select_length):
+        def setup():
+            write_markov_feed()
+            model = plommarkov.MarkovModel(markov_path)
+            for order in range(1, select_length + 1):
+                model.table(order)
+
+            def run():
+                tokens = model.generate(select_length)
+                for i in range(GENERATE_TOKENS):
+                    next(tokens)
+                return 1
+            return run
+        return setup
+
+    yield "search_parse", search_parse
+    for size in opts.sizes:
+        yield "search_index_" + str(size), search_index(size)
+        yield "search_" + str(size), search(size, True, queries)
+        yield "search_unindexed_" + str(size), search(size, False, queries)
+        yield "search_batch_" + str(size), search_batch(size, queries)
+        yield "search_rare_unindexed_" + str(size), \
+            search(size, False, rare_queries)
+        yield "search_rare_batch_" + str(size), \
+            search_batch(size, rare_queries)
+    yield "line_parse", line_parse
+    yield "format_logline", format_logline
+    yield "log_log", log_log
+    yield "markov_build", markov_build
+    yield "markov_snapshot_load", markov_snapshot_load
+    for select_length in opts.select_lengths:
+        yield "markov_generate_" + str(select_length), \
+            markov_generate(select_length)
+
+
+def measure(run, min_time):
+    # Operations per second of run, repeated for at least min_time seconds.
+    gc.collect()
+    ops = 0
+    start = time.perf_counter()
+    while True:
+        ops += run()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return ops / elapsed
+
+
+def peak_memory(run):
+    # Peak bytes allocated during one more call of run.
+    gc.collect()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        change = 100 * (result["ops_per_sec"] /
+                        baseline[name]["ops_per_sec"] - 1)
+        verdict = ""
+        if change < -threshold:
+            verdict = "  REGRESSION"
+            regressions += 1
+        print("%-26s %+8.1f%% ops/sec, %+8.1f%% peak memory%s" %
+              (name, change, 100 * ((result["peak_kib"] + 1) /
+                                    (baseline[name]["peak_kib"] + 1) - 1),
+               verdict))
+    return regressions
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description="offline microbenchmarks "
+                                     "for plomlombot's hot paths")
+    parser.add_argument("-t", "--min_time", action="store", dest="min_time",
+                        type=float, default=MIN_TIME,
+                        help="seconds to repeat each benchmark for at least "
+                        "(default: " + str(MIN_TIME) + ")")
+    parser.add_argument("-S", "--sizes", action="store", dest="sizes",
+                        type=int, nargs="+", default=SIZES,
+                        help="quote corpus sizes to search (default: "
+                        + str.join(" ", [str(size) for size in SIZES]) + ")")
+    parser.add_argument("-l", "--select_lengths", action="store",
+                        dest="select_lengths", type=int, nargs="+",
+                        default=SELECT_LENGTHS,
+                        help="markov select lengths to generate with "
+                        "(default: " + str.join(" ", [str(length) for length
+                                                     in SELECT_LENGTHS])
+                        + ")")
+    parser.add_argument("-r", "--raw_log", action="store", dest="raw_log",
+                        default=None,
+                        help="raw_logs/ day file to parse and format instead "
+                        "of synthetic lines")
+    parser.add_argument("-s", "--save", action="store", dest="save",
+                        default=None, help="JSON file to save results to as "
+                        "a baseline")
+    parser.add_argument("-c", "--compare", action="store", dest="compare",
+                        default=None, help="JSON baseline file to compare "
+                        "results with; exits with 1 on regressions")
+    parser.add_argument("-T", "--threshold", action="store", dest="threshold",
+                        type=float, default=REGRESSION_THRESHOLD,
+                        help="percent of ops/sec lost that counts as "
+                        "regression (default: " + str(REGRESSION_THRESHOLD)
+                        + ")")
+    parser.add_argument("--seed", action="store", dest="seed", type=int,
+                        default=SEED, help="seed for the synthetic data "
+                        "(default: " + str(SEED) + ")")
+    parser.add_argument("NAME", action="store", nargs="*",
+                        help="only run benchmarks whose names contain one of "
+                        "these")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opts = parse_command_line_arguments()
+    tmpdir = tempfile.mkdtemp(prefix="plombench")
+    results = {}
+    try:
+        for name, setup in benchmarks(opts, tmpdir):
+            if len(opts.NAME) > 0 and \
+                    not any(pattern in name for pattern in opts.NAME):
+                continue
+            run = setup()
+            ops_per_sec = measure(run, opts.min_time)
+            peak = peak_memory(run)
+            results[name] = {"ops_per_sec": ops_per_sec,
+                             "peak_kib": peak / 1024}
+            print("%-26s %14.1f ops/sec %12.1f KiB peak" %
+                  (name, ops_per_sec, peak / 1024))
+    finally:
+        shutil.rmtree(tmpdir)
+    if opts.save != None:
+        f = open(opts.save, "w")
+        json.dump({"python": platform.python_version(),
+                   "machine": platform.machine(), "time": time.time(),
+                   "results": results}, f, indent=1, sort_keys=True)
+        f.close()
+    if opts.compare != None:
+        f = open(opts.compare, "r")
+        baseline = json.load(f)["results"]
+        f.close()
+        print()
+        if compare(results, baseline, opts.threshold) > 0:
+            sys.exit(1)
@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+import contextlib
+import functools
+import socket
+import threading
+import time
+import urllib.parse
+import requests
+import urllib3
+
+TOTAL_CONNECTIONS = 8
+HOST_CONNECTIONS = 2
+MAX_REDIRECTS = 5
+MAX_SIZE = 10000000
+TIMEOUT = 15
+DNS_TTL = 300
+DNS_CACHE_SIZE = 256
+
+
+class FetchTimeout(Exception):
+    pass
+
+
+class DNSCache:
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, *args):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(args)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        result = socket.getaddrinfo(*args)
+        with self.lock:
+            if len(self.entries) >= self.size:
+                for old_key in [old_key for old_key, entry
+                                in self.entries.items() if entry[0] <= now]:
+                    del self.entries[old_key]
+                if len(self.entries) >= self.size:
+                    self.entries.clear()
+            self.entries[args] = (now + self.ttl, result)
+        return result
+
+    def discard(self, *args):
+        with self.lock:
+            self.entries.pop(args, None)
+
+
+class _CachedDNSConnection:
+
+    # Connects to the addresses a DNSCache knows for the host, rather than
+    # have urllib3 resolve it for each new connection. Overrides internals
+    # of urllib3 2's HTTPConnection, hence the urllib3 pin in
+    # requirements.txt.
+
+    def __init__(self, *args, dns_cache=None, **kwargs):
+        self.dns_cache = dns_cache
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        host = self._dns_host
+        key = (host.strip("[]"), self.port,
+               urllib3.util.connection.allowed_gai_family(),
+               socket.SOCK_STREAM)
+        try:
+            addresses = self.dns_cache.lookup(*key)
+        except socket.gaierror:
+            return super()._new_conn()
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address[4][0]
+                try:
+                    return super()._new_conn()
+                except urllib3.exceptions.ConnectTimeoutError as e:
+                    error = e
+        finally:
+            self._dns_host = host
+
+        # None of the cached addresses answered, so resolve anew next time.
+        self.dns_cache.discard(*key)
+        if error is None:
+            return super()._new_conn()
+        raise error
+
+
+class _CachedDNSHTTPConnection(_CachedDNSConnection,
+                               urllib3.connection.HTTPConnection):
+    pass
+
+
+class _CachedDNSHTTPSConnection(_CachedDNSConnection,
+                                urllib3.connection.HTTPSConnection):
+    pass
+
+
+class _CachedDNSHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _CachedDNSHTTPConnection
+
+
+class _CachedDNSHTTPSConnectionPool(
+        urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _CachedDNSHTTPSConnection
+
+
+class _CachedDNSAdapter(requests.adapters.HTTPAdapter):
+
+    def __init__(self, dns_cache, **kwargs):
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": functools.partial(_CachedDNSHTTPConnectionPool,
+                                      dns_cache=self.dns_cache),
+            "https": functools.partial(_CachedDNSHTTPSConnectionPool,
+                                       dns_cache=self.dns_cache)}
+
+
+class Fetcher:
+
+    def __init__(self, total=TOTAL_CONNECTIONS, per_host=HOST_CONNECTIONS,
+                 max_redirects=MAX_REDIRECTS, max_size=MAX_SIZE,
+                 timeout=TIMEOUT, dns_ttl=DNS_TTL):
+        self.per_host = per_host
+        self.max_size = max_size
+        self.timeout = timeout
+        self.total = threading.BoundedSemaphore(total)
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.max_redirects = max_redirects
+        self.session.headers["User-Agent"] = "plomlombot"
+        self.dns_cache = None
+        if dns_ttl > 0:
+            self.dns_cache = DNSCache(dns_ttl, DNS_CACHE_SIZE)
+            adapter = _CachedDNSAdapter(self.dns_cache,
+                                        pool_connections=total,
+                                        pool_maxsize=per_host)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=total,
+                                                    pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _acquire(self, semaphore, deadline):
+        if not semaphore.acquire(timeout=max(deadline - time.time(), 0)):
+            raise FetchTimeout("timeout")
+
+    def _host_slot(self, host):
+        with self.hosts_lock:
+            slot = self.hosts.get(host)
+            if slot is None:
+                slot = [threading.BoundedSemaphore(self.per_host), 0]
+                self.hosts[host] = slot
+            slot[1] += 1
+        return slot
+
+    def _release_host_slot(self, host, slot):
+        with self.hosts_lock:
+            slot[1] -= 1
+            if slot[1] == 0:
+                del self.hosts[host]
+
+    def _expire(self, r):
+        # Shut the response's socket down, so that a read blocked on it
+        # returns at once rather than after the socket timeout.
+        sock = getattr(r.raw.connection, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @contextlib.contextmanager
+    def get(self, url, deadline):
+        host = urllib.parse.urlsplit(url).hostname or ""
+        slot = self._host_slot(host)
+        try:
+            self._acquire(slot[0], deadline)
+            try:
+                self._acquire(self.total, deadline)
+                try:
+                    r = self.session.get(url, stream=True, timeout=max(
+                        deadline - time.time(), 0.001))
+                    timer = threading.Timer(max(deadline - time.time(), 0),
+                                            self._expire, [r])
+                    timer.daemon = True
+                    timer.start()
+                    try:
+                        yield r
+                    finally:
+                        timer.cancel()
+                        r.close()
+                finally:
+                    self.total.release()
+            finally:
+                slot[0].release()
+        finally:
+            self._release_host_slot(host, slot)
+
+    def iter_body(self, r, deadline, chunk_size):
+
+        # Reads cut short by get()'s timer at the deadline surface as
+        # connection errors or an early end of the body.
+        read_len = 0
+        try:
+            for chunk in r.iter_content(chunk_size):
+                if time.time() > deadline:
+                    raise FetchTimeout("timeout")
+                read_len += len(chunk)
+                if read_len > self.max_size:
+                    raise ValueError('Too large a response')
+                yield chunk
+        except (requests.exceptions.RequestException, OSError):
+            if time.time() > deadline:
+                raise FetchTimeout("timeout")
+            raise
+        if time.time() > deadline:
+            raise FetchTimeout("timeout")
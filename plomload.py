@@ -0,0 +1,498 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import http.server
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import irclog
+
+# Defaults, may be overwritten by command line arguments.
+CHANNEL = "#plomload"
+USERS = 50
+RATES = [25, 50, 100, 200, 400, 800, 1600]
+STEP_TIME = 10
+TIMEOUT = 30
+MAX_LAG = 1.0
+COMMAND_SHARE = 0.05
+URL_SHARE = 0.02
+CHURN_SHARE = 0.02
+HTTP_DELAY = 0.05
+BOT_ARGS = "-R 0"
+PING_INTERVAL = 0.5
+PROBE_INTERVAL = 0.2
+PROBE_NICK = "plomprobe"
+SERVER_NAME = "fake.server"
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "plomlombot.py")
+
+
+class HTTPStubHandler(http.server.BaseHTTPRequestHandler):
+
+    # Serves "load page N" titled pages for any /N, after a delay.
+    delay = HTTP_DELAY
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        page = self.path.strip("/")
+        body = ("<!DOCTYPE html><html><head><title>load page " + page
+                + "</title></head><body>" + "lorem ipsum " * 100
+                + "</body></html>").encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_stub(delay):
+    HTTPStubHandler.delay = delay
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), HTTPStubHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class FakeIRCServer:
+
+    # Just enough of an IRC server for one bot connection: registration,
+    # JOIN with NAMES, PING/PONG both ways, and bookkeeping of the bot's
+    # PONGs and NOTICEs to time them against what provoked them.
+
+    def __init__(self, channel, users, echo=False):
+        self.channel = channel
+        self.users = users
+        self.echo = echo
+        self.writer = None
+        self.bot_nick = None
+        self.joined = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.pings = {}
+        self.pong_latencies = []
+        self.url_posted = {}
+        self.url_latencies = []
+        self.probe_waiter = None
+        self.lines_from_bot = 0
+
+    async def start(self, port):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1",
+                                                 port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        if self.writer != None:
+            writer.close()
+            return
+        self.writer = writer
+        self.send(":" + SERVER_NAME + " NOTICE * :*** plomload fake server")
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                self.handle_line(str(data, "utf-8", "replace").rstrip("\r\n"))
+        except ConnectionError:
+            pass
+        self.closed.set()
+
+    def send(self, line):
+        if self.writer != None and not self.closed.is_set():
+            self.writer.write(bytes(line + "\r\n", "utf-8"))
+
+    def user_line(self, nick, rest):
+        self.send(":" + nick + "!" + nick + "@load.test " + rest)
+
+    def handle_line(self, raw_line):
+        now = time.perf_counter()
+        self.lines_from_bot += 1
+        if self.echo:
+            print("BOT> " + raw_line)
+        line = irclog.Line(raw_line)
+        command = line.command
+        params = line.params
+        if command == "NICK" and len(params) > 0:
+            self.bot_nick = params[0]
+        elif command == "USER":
+            self.send(":" + SERVER_NAME + " 001 " + self.bot_nick
+                      + " :Welcome to plomload")
+        elif command == "JOIN" and len(params) > 0:
+            for channel in params[0].split(","):
+                self.send(":" + self.bot_nick + "!bot@load.test JOIN "
+                          + channel)
+                names = [self.bot_nick] + ["@" + self.users[0]] + \
+                    self.users[1:]
+                for i in range(0, len(names), 40):
+                    self.send(":" + SERVER_NAME + " 353 " + self.bot_nick
+                              + " = " + channel + " :"
+                              + str.join(" ", names[i:i + 40]))
+                self.send(":" + SERVER_NAME + " 366 " + self.bot_nick + " "
+                          + channel + " :End of /NAMES list.")
+            self.joined.set()
+        elif command == "PING":
+            self.send(":" + SERVER_NAME + " PONG " + SERVER_NAME + " :"
+                      + (params[-1] if params else ""))
+        elif command == "PONG" and len(params) > 0:
+            sent = self.pings.pop(params[-1], None)
+            if sent != None:
+                self.pong_latencies += [(now, now - sent)]
+        elif command == "NOTICE" and len(params) > 1:
+            if params[0] == PROBE_NICK and self.probe_waiter != None and \
+                    not self.probe_waiter.done():
+                self.probe_waiter.set_result(now)
+            for page in re.findall("load page ([0-9]+)", params[1]):
+                posted = self.url_posted.pop(page, None)
+                if posted != None:
+                    self.url_latencies += [now - posted]
+
+    def ping(self, token):
+        self.pings[token] = time.perf_counter()
+        self.send("PING :" + token)
+
+    def lag(self):
+        # Latency of the last PONG, or age of the oldest unanswered PING if
+        # that's longer.
+        lag = self.pong_latencies[-1][1] if self.pong_latencies else 0
+        if self.pings:
+            lag = max(lag, time.perf_counter() - min(self.pings.values()))
+        return lag
+
+
+class LoadGenerator:
+
+    def __init__(self, server, opts, url_base):
+        self.server = server
+        self.opts = opts
+        self.url_base = url_base
+        self.rng = random.Random(0)
+        self.words = ["".join(self.rng.choice("abcdefghijklmnopqrstuvwxyz")
+                              for i in range(self.rng.randint(2, 8)))
+                      for i in range(1000)]
+        self.present = list(server.users)
+        self.absent = []
+        self.pages = 0
+        self.pings = 0
+        self.probe_latencies = []
+        self.probe_timeouts = 0
+
+    def sentence(self):
+        return str.join(" ", self.rng.choices(self.words,
+                                              k=self.rng.randint(3, 15)))
+
+    def load_line(self):
+        rng = self.rng
+        nick = rng.choice(self.present)
+        kind = rng.random()
+        if kind < self.opts.command_share:
+            command = rng.choice(["!quote", "!markov", "!markov 3",
+                                  "!quote search " + rng.choice(self.words),
+                                  "!addquote " + self.sentence()])
+            self.server.user_line(nick, "PRIVMSG " + self.server.channel
+                                  + " :" + command)
+            return
+        kind -= self.opts.command_share
+        if kind < self.opts.url_share:
+            urls = []
+            for i in range(3):
+                self.pages += 1
+                self.server.url_posted[str(self.pages)] = time.perf_counter()
+                urls += [self.url_base + str(self.pages)]
+            self.server.user_line(nick, "PRIVMSG " + self.server.channel
+                                  + " :look " + str.join(" ", urls))
+            return
+        kind -= self.opts.url_share
+        if kind < self.opts.churn_share:
+            churn = rng.random()
+            if churn < 0.3 and len(self.absent) > 0:
+                nick = self.absent.pop(rng.randrange(len(self.absent)))
+                self.present += [nick]
+                self.server.user_line(nick, "JOIN " + self.server.channel)
+            elif churn < 0.8 and len(self.present) > 1:
+                self.present.remove(nick)
+                self.absent += [nick]
+                self.server.user_line(nick, rng.choice(
+                    ["PART " + self.server.channel + " :bye", "QUIT :gone"]))
+            elif churn < 0.9 and len(self.present) > 1:
+                victim = rng.choice(self.present)
+                if victim != nick:
+                    self.present.remove(victim)
+                    self.absent += [victim]
+                    self.server.user_line(nick, "KICK " + self.server.channel
+                                          + " " + victim + " :load")
+            else:
+                new_nick = nick + "_"
+                if len(new_nick) > 16:
+                    new_nick = "u" + str(rng.randrange(100000))
+                self.present[self.present.index(nick)] = new_nick
+                self.server.user_line(nick, "NICK :" + new_nick)
+            return
+        self.server.user_line(nick, "PRIVMSG " + self.server.channel + " :"
+                              + self.sentence())
+
+    async def probe(self):
+
+        # One command at a time, in a private query so the reply is told apart
+        # from the channel traffic.
+        commands = ["!quote", "!markov", "!quote search "
+                    + self.words[0], "!markov 3", "!quote 1"]
+        loop = asyncio.get_running_loop()
+        i = 0
+        while not self.server.closed.is_set():
+            waiter = loop.create_future()
+            self.server.probe_waiter = waiter
+            sent = time.perf_counter()
+            self.server.user_line(PROBE_NICK, "PRIVMSG "
+                                  + self.server.bot_nick + " :"
+                                  + commands[i % len(commands)])
+            i += 1
+            try:
+                answered = await asyncio.wait_for(waiter, self.opts.timeout)
+                self.probe_latencies += [answered - sent]
+            except asyncio.TimeoutError:
+                self.probe_timeouts += 1
+            await asyncio.sleep(PROBE_INTERVAL)
+
+    async def run_step(self, rate, seconds, probing=True):
+        server = self.server
+        server.pong_latencies = []
+        server.url_latencies = []
+        self.probe_latencies = []
+        self.probe_timeouts = 0
+        lag_start = server.lag()
+        bot_lines = server.lines_from_bot
+        sent = 0
+        start = time.perf_counter()
+        next_ping = start
+        while not server.closed.is_set():
+            now = time.perf_counter()
+            elapsed = now - start
+            if elapsed >= seconds:
+                break
+            for i in range(int(rate * elapsed) - sent):
+                self.load_line()
+            sent = max(sent, int(rate * elapsed))
+            if now >= next_ping:
+                self.pings += 1
+                server.ping("plomload" + str(self.pings))
+                next_ping += PING_INTERVAL
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        lag_end = server.lag()
+        growth = (lag_end - lag_start) / elapsed
+        pongs = [latency for answered, latency in server.pong_latencies]
+        step = {"rate": rate, "sent_per_sec": sent / elapsed,
+                "bot_lines_per_sec": (server.lines_from_bot - bot_lines)
+                / elapsed,
+                "pong_p50": percentile(pongs, 0.5),
+                "pong_max": max(pongs) if pongs else None,
+                "command_p50": percentile(self.probe_latencies, 0.5),
+                "command_p95": percentile(self.probe_latencies, 0.95),
+                "command_timeouts": self.probe_timeouts,
+                "url_p50": percentile(server.url_latencies, 0.5),
+                "url_p95": percentile(server.url_latencies, 0.95),
+                "lag": lag_end, "lag_growth": growth,
+                "seconds_to_timeout": None,
+                "sustained": lag_end <= self.opts.max_lag and
+                not server.closed.is_set()}
+        if growth > 0:
+            step["seconds_to_timeout"] = \
+                max(self.opts.timeout - lag_end, 0) / growth
+        return step
+
+
+def format_ms(seconds):
+    if seconds == None:
+        return "-"
+    return "%.1fms" % (1000 * seconds)
+
+
+def print_step(step):
+    print("%6d lines/s: sent %7.1f/s, bot %6.1f lines/s, command p50 %s "
+          "p95 %s (%d timeouts), pong p50 %s max %s, url p50 %s p95 %s, "
+          "lag %s%s%s" %
+          (step["rate"], step["sent_per_sec"], step["bot_lines_per_sec"],
+           format_ms(step["command_p50"]), format_ms(step["command_p95"]),
+           step["command_timeouts"], format_ms(step["pong_p50"]),
+           format_ms(step["pong_max"]), format_ms(step["url_p50"]),
+           format_ms(step["url_p95"]), format_ms(step["lag"]),
+           "" if step["sustained"] or step["seconds_to_timeout"] == None
+           else ", TIMEOUT in %.0fs" % step["seconds_to_timeout"],
+           "" if step["sustained"] else "  NOT SUSTAINED"))
+
+
+async def serve(opts, users):
+    httpd = start_http_stub(opts.http_delay)
+    server = FakeIRCServer(opts.channel, users, echo=True)
+    port = await server.start(opts.port)
+    print("FAKE IRC SERVER ON 127.0.0.1:" + str(port) + ", HTTP STUB ON "
+          "http://127.0.0.1:" + str(httpd.server_address[1]) + "/")
+    pings = 0
+    while True:
+        await asyncio.sleep(opts.timeout / 2)
+        pings += 1
+        server.ping("plomload" + str(pings))
+
+
+async def load_test(opts, users):
+    httpd = start_http_stub(opts.http_delay)
+    url_base = "http://127.0.0.1:" + str(httpd.server_address[1]) + "/"
+    server = FakeIRCServer(opts.channel, users)
+    port = await server.start(opts.port)
+    dbdir = tempfile.mkdtemp(prefix="plomload")
+    bot_output = open(os.path.join(dbdir, "bot_output.txt"), "w")
+    bot = subprocess.Popen([sys.executable, opts.bot, "-s", "127.0.0.1",
+                            "-p", str(port), "-d", dbdir, "-w",
+                            str(opts.timeout), "-v", "info", "-m"]
+                           + shlex.split(opts.bot_args) + [opts.channel],
+                           stdout=bot_output, stderr=subprocess.STDOUT)
+    steps = []
+    try:
+        await asyncio.wait_for(server.joined.wait(), opts.timeout)
+        generator = LoadGenerator(server, opts, url_base)
+
+        # Some quotes and markov input to work with before measuring.
+        for i in range(100):
+            server.user_line(users[i % len(users)], "PRIVMSG " + opts.channel
+                             + " :!addquote " + generator.sentence())
+        await generator.run_step(50, 5)
+        probe = asyncio.get_running_loop().create_task(generator.probe())
+        for rate in opts.rates:
+            step = await generator.run_step(rate, opts.step_time)
+            steps += [step]
+            print_step(step)
+            if not step["sustained"]:
+                break
+        probe.cancel()
+    except asyncio.TimeoutError:
+        print("BOT DID NOT JOIN WITHIN " + str(opts.timeout) + " SECONDS")
+    finally:
+        dropped = server.closed.is_set() or bot.poll() != None
+        if bot.poll() == None:
+            bot.send_signal(signal.SIGTERM)
+            try:
+                bot.wait(10)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+        bot_output.close()
+        try:
+            await asyncio.wait_for(server.closed.wait(), 5)
+        except asyncio.TimeoutError:
+            pass
+        server.server.close()
+        if dropped:
+            print("BOT DROPPED THE CONNECTION OR EXITED, ITS OUTPUT:")
+            f = open(os.path.join(dbdir, "bot_output.txt"))
+            print(f.read()[-4000:])
+            f.close()
+        if opts.keep:
+            print("BOT DB DIR KEPT AT " + dbdir)
+        else:
+            shutil.rmtree(dbdir)
+    sustained = [step for step in steps if step["sustained"]]
+    if len(sustained) > 0:
+        best = max(sustained, key=lambda step: step["rate"])
+        print("MAX SUSTAINED RATE: %d lines/s offered, %.1f lines/s sent" %
+              (best["rate"], best["sent_per_sec"]))
+    else:
+        print("NO SUSTAINED RATE FOUND")
+    return steps
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description="load test plomlombot "
+                                     "against a local fake IRC server")
+    parser.add_argument("-p, --port", action="store", dest="port", type=int,
+                        default=0, help="port for the fake IRC server "
+                        "(default: any free one)")
+    parser.add_argument("-c, --channel", action="store", dest="channel",
+                        default=CHANNEL,
+                        help="channel to load (default: " + CHANNEL + ")")
+    parser.add_argument("-u, --users", action="store", dest="users",
+                        type=int, default=USERS, help="number of simulated "
+                        "users (default: " + str(USERS) + ")")
+    parser.add_argument("-r, --rates", action="store", dest="rates",
+                        type=int, nargs="+", default=RATES,
+                        help="channel lines per second to step through until "
+                        "the bot can't keep up (default: "
+                        + str.join(" ", [str(rate) for rate in RATES]) + ")")
+    parser.add_argument("-t, --step_time", action="store", dest="step_time",
+                        type=float, default=STEP_TIME,
+                        help="seconds per rate step (default: "
+                        + str(STEP_TIME) + ")")
+    parser.add_argument("-w, --wait", action="store", dest="timeout",
+                        type=int, default=TIMEOUT,
+                        help="timeout passed to the bot, also how long to "
+                        "wait for command replies (default: " + str(TIMEOUT)
+                        + ")")
+    parser.add_argument("-l, --max_lag", action="store", dest="max_lag",
+                        type=float, default=MAX_LAG,
+                        help="PING/PONG lag in seconds beyond which a rate "
+                        "counts as not sustained (default: " + str(MAX_LAG)
+                        + ")")
+    parser.add_argument("-C, --command_share", action="store",
+                        dest="command_share", type=float,
+                        default=COMMAND_SHARE,
+                        help="share of lines that are !quote/!markov "
+                        "commands (default: " + str(COMMAND_SHARE) + ")")
+    parser.add_argument("-U, --url_share", action="store", dest="url_share",
+                        type=float, default=URL_SHARE,
+                        help="share of lines that post three urls (default: "
+                        + str(URL_SHARE) + ")")
+    parser.add_argument("-j, --churn_share", action="store",
+                        dest="churn_share", type=float, default=CHURN_SHARE,
+                        help="share of lines that are JOIN, PART, QUIT, KICK "
+                        "or NICK (default: " + str(CHURN_SHARE) + ")")
+    parser.add_argument("-d, --http_delay", action="store", dest="http_delay",
+                        type=float, default=HTTP_DELAY,
+                        help="seconds the HTTP stub takes per page (default: "
+                        + str(HTTP_DELAY) + ")")
+    parser.add_argument("-b, --bot", action="store", dest="bot",
+                        default=BOT_SCRIPT, help="bot script to run "
+                        "(default: plomlombot.py next to this script)")
+    parser.add_argument("-B, --bot_args", action="store", dest="bot_args",
+                        default=BOT_ARGS, help="further arguments for the "
+                        "bot (default: " + BOT_ARGS + ")")
+    parser.add_argument("-o, --output", action="store", dest="output",
+                        default=None, help="JSON file to write step results "
+                        "to")
+    parser.add_argument("-k, --keep", action="store_true", dest="keep",
+                        help="keep the bot's DB directory")
+    parser.add_argument("-S, --serve", action="store_true", dest="serve",
+                        help="only run the fake IRC server and HTTP stub, "
+                        "printing what a bot sends, for manual testing")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opts = parse_command_line_arguments()
+    users = ["loaduser" + str(i) for i in range(max(opts.users, 1))]
+    try:
+        if opts.serve:
+            asyncio.run(serve(opts, users))
+        else:
+            steps = asyncio.run(load_test(opts, users))
+            if opts.output != None:
+                f = open(opts.output, "w")
+                json.dump(steps, f, indent=1)
+                f.close()
+    except KeyboardInterrupt:
+        pass
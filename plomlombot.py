@@ -1,18 +1,29 @@
 #!/usr/bin/python3
 
 import argparse
-import socket
+import array
+import asyncio
+import codecs
+import collections
+import concurrent.futures
 import datetime
-import select
 import time
 import re
 import requests
-import bs4
 import random
 import hashlib
+import html.parser
+import json
 import os
 import signal
+import struct
+import sys
+import traceback
+import urllib.parse
+import plomfetch
+import plommetrics
 import plomsearch
+import plommarkov
 import irclog
 
 # Defaults, may be overwritten by command line arguments.
@@ -23,6 +34,27 @@ USERNAME = "plomlombot"
 NICKNAME = USERNAME
 TWTFILE = ""
 DBDIR = os.path.expanduser("~/plomlombot_db")
+LOG_FSYNC = "never"
+RECONNECT_WAIT = 30
+URL_TIMEOUT = 15
+URL_WORKERS = 4
+URL_CHUNK_SIZE = 4096
+URL_CACHE_SIZE = 1000
+URL_CACHE_TTL = 24 * 60 * 60
+URL_CACHE_NEGATIVE_TTL = 10 * 60
+URL_CACHE_SAVE_INTERVAL = 60
+SEND_BURST = 5
+SEND_RATE = 1.0
+MAX_LINE_BYTES = 510
+NOTICE_JOINER = " | "
+VERBOSITY = "lines"
+VERBOSITIES = ["quiet", "info", "lines"]
+METRICS_INTERVAL = 15
+
+
+def say(msg, level="info"):
+    if VERBOSITIES.index(level) <= VERBOSITIES.index(VERBOSITY):
+        print(msg)
 
 
 def write_to_file(path, mode, text):
@@ -31,169 +63,419 @@ def write_to_file(path, mode, text):
     f.close()
 
 
+def split_lines(text):
+    # Unlike str.splitlines(), split at "\n" only, as quotes may contain
+    # IRC formatting codes that splitlines() takes for line separators.
+    lines = text.split("\n")
+    last = lines.pop()
+    return [line + "\n" for line in lines] + ([last] if last != "" else [])
+
+
+def split_utf8(text, max_bytes):
+
+    # Split text into pieces of at most max_bytes UTF-8 bytes, at a space in
+    # the piece's second half if there is one, and never inside a character.
+    data = text.encode("utf-8")
+    pieces = []
+    while len(data) > max_bytes:
+        cut = max_bytes
+        while cut > 0 and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        space = data.rfind(b" ", max_bytes // 2, cut + 1)
+        if space > 0:
+            pieces += [str(data[:space], "utf-8")]
+            data = data[space + 1:]
+        else:
+            pieces += [str(data[:cut], "utf-8")]
+            data = data[cut:]
+    return pieces + [str(data, "utf-8")]
+
+
 class ExceptionForRestart(Exception):
     pass
 
 
-class Line:
+class IRCProtocol(asyncio.Protocol):
 
-    def __init__(self, line):
-        self.line = line
-        self.tokens = line.split(" ")
-        self.sender = ""
-        if self.tokens[0][0] == ":":
-            for rune in self.tokens[0][1:]:
-                if rune in {"!", "@"}:
-                    break
-                self.sender += rune
-        self.receiver = ""
-        if len(self.tokens) > 2:
-            for rune in self.tokens[2]:
-                if rune in {"!", "@"}:
-                    break
-                if rune != ":":
-                    self.receiver += rune
+    def __init__(self, io):
+        self.io = io
 
+    def connection_made(self, transport):
+        self.io.transport = transport
 
-class Log:
+    def data_received(self, data):
+        self.io._feed(data)
 
-    def __init__(self, chandir, nickname, username, channel, rmlogs):
-        self.nickname = nickname
-        self.username = username
-        self.channel = channel
-        self.chandir = chandir
-        self.rmlogcycle = rmlogs
-        self.rawlogdir = chandir + "raw_logs/"
-        self.logdir = chandir + "logs/"
-        if not os.path.exists(self.logdir):
-            os.makedirs(self.logdir)
-        if not os.path.exists(self.rawlogdir):
-            os.makedirs(self.rawlogdir)
-
-    def log(self, line, sent=False):
-        identity = ""
-        separator = " > "
-        if sent:
-            separator = " "
-            line = Line("< " + line)
-            line.sender = self.nickname
-            identity = self.username + "@localhost"
-        else:
-            if type(line) == str:
-                line = Line(line)
-        now = datetime.datetime.utcnow()
-        form = "%Y-%m-%d %H:%M:%S UTC"
-        write_to_file(self.rawlogdir + now.strftime("%Y-%m-%d") + ".txt", "a",
-                      now.strftime(form) + separator + line.line + "\n")
-        to_log = irclog.format_logline(line, self.channel, identity)
-        if to_log != None:
-            write_to_file(self.logdir + now.strftime("%Y-%m-%d") + ".txt", "a",
-                          now.strftime(form) + " " + to_log + "\n")
+    def connection_lost(self, exc):
+        say("SOCKET CONNECTION BROKEN")
+        self.io._break()
 
-    def rmlogs(self):
-        if self.rmlogcycle > 0:
-            for f in os.listdir(self.logdir):
-                f = os.path.join(self.logdir, f)
-                if os.path.isfile(f) and \
-                        os.stat(f).st_mtime < time.time() - self.rmlogcycle:
-                    os.remove(f)
+    def pause_writing(self):
+        self.io.can_write.clear()
 
-    def separator_line(self):
-        now = datetime.datetime.utcnow()
-        write_to_file(self.logdir + now.strftime("%Y-%m-%d") + ".txt", "a",
-                      "-----------------------\n")
+    def resume_writing(self):
+        self.io.can_write.set()
 
 
 class IO:
 
-    def __init__(self, server, port, timeout):
+    def __init__(self, timeout, send_rate=SEND_RATE, send_burst=SEND_BURST):
         self.log = None
         self.timeout = timeout
-        self.socket = socket.socket()
+        self.send_rate = send_rate
+        self.send_burst = max(send_burst, 1)
+        self.send_tokens = self.send_burst
+        self.send_time = time.time()
+        self.send_queues = [collections.deque(), collections.deque(),
+                            collections.deque()]
+        self.send_ready = asyncio.Event()
+        self.sender = None
+        self.transport = None
+        self.servername = None
+        self.broken = False
+        self.ready = asyncio.Event()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.keepalive = None
+        self.line_buffer = collections.deque()
+        self.recv_buffer = bytearray()
+        self.last_pong = time.time()
+
+    @classmethod
+    async def connect(cls, server, port, timeout, send_rate=SEND_RATE,
+                      send_burst=SEND_BURST):
+        io = cls(timeout, send_rate, send_burst)
+        loop = asyncio.get_running_loop()
         try:
-            self.socket.connect((server, port))
+            await loop.create_connection(lambda: IRCProtocol(io), server, port)
         except TimeoutError:
             raise ExceptionForRestart
-        self.socket.setblocking(0)
-        self.line_buffer = []
-        self.rune_buffer = ""
-        self.last_pong = time.time()
-        line = self.recv_line(send_ping=False)
-        if not line or len(line) < 1:
+        line = await io.recv_line()
+        if line == None:
+            io.close()
             raise ExceptionForRestart
-        self.servername = line.split(" ")[0][1:]
+        io.servername = line.prefix or server
+        io.keepalive = loop.create_task(io._keepalive())
+        io.sender = loop.create_task(io._send_loop())
+        return io
 
-    def _pingtest(self, send_ping=True):
-        if self.last_pong + self.timeout < time.time():
-            print("SERVER NOT ANSWERING")
-            raise ExceptionForRestart
-        if send_ping:
-            self.send_line("PING " + self.servername)
+    def _feed(self, received_bytes):
+        self.last_pong = time.time()
+        plommetrics.inc("bytes_received", len(received_bytes))
+        buffer = self.recv_buffer
+        scan_from = max(len(buffer) - 1, 0)
+        buffer += received_bytes
+        start = 0
+        end = buffer.find(b"\r\n", scan_from)
+        if end < 0:
+            return
+        with memoryview(buffer) as view:
+            while end >= 0:
+                line = view[start:end]
+                try:
+                    self.line_buffer.append(str(line, "UTF-8"))
+                except UnicodeDecodeError:
+                    self.line_buffer.append(str(line, "latin1"))
+                line.release()
+                start = end + 2
+                end = buffer.find(b"\r\n", start)
+        del buffer[:start]
+        self.ready.set()
+
+    def _break(self):
+        self.broken = True
+        self.ready.set()
+        self.can_write.set()
+        self.send_ready.set()
+
+    def close(self):
+        if self.keepalive is not None:
+            self.keepalive.cancel()
+        if self.sender is not None:
+            self.sender.cancel()
+        if self.transport is not None:
+            self.transport.close()
+        self._break()
+
+    async def _keepalive(self):
+        try:
+            while not self.broken:
+                await asyncio.sleep(self.timeout / 2)
+                idle = time.time() - self.last_pong
+                if idle > self.timeout:
+                    say("SERVER NOT ANSWERING")
+                    self.close()
+                elif idle >= self.timeout / 2:
+                    await self.send_line("PING " + self.servername)
+        except ExceptionForRestart:
+            pass
+
+    def write_line(self, msg):
 
-    def send_line(self, msg):
+        # Queue msg by priority: PONGs first, then other protocol lines, then
+        # NOTICEs and PRIVMSGs, the latter split to fit the line length limit.
         msg = msg.replace("\r", " ")
         msg = msg.replace("\n", " ")
-        if len(msg.encode("utf-8")) > 510:
-            print("NOT SENT LINE TO SERVER (too long): " + msg)
-        print("LINE TO SERVER: "
-              + str(datetime.datetime.now()) + ": " + msg)
-        if self.log != None:
-            self.log.log(msg, True)
-        msg = msg + "\r\n"
-        msg_len = len(msg)
-        total_sent_len = 0
-        while total_sent_len < msg_len:
-            sent_len = self.socket.send(bytes(msg[total_sent_len:], "UTF-8"))
-            if sent_len == 0:
-                print("SOCKET CONNECTION BROKEN")
-                raise ExceptionForRestart
-            total_sent_len += sent_len
-
-    def _recv_line_wrapped(self, send_ping=True):
-        if len(self.line_buffer) > 0:
-            return self.line_buffer.pop(0)
+        if self.broken:
+            raise ExceptionForRestart
+        command = msg.split(" ", 1)[0].upper()
+        if command == "PONG":
+            send_queue = self.send_queues[0]
+        elif command in {"NOTICE", "PRIVMSG"}:
+            send_queue = self.send_queues[2]
+        else:
+            send_queue = self.send_queues[1]
+        head, colon, text = msg.partition(" :")
+        if len(msg.encode("utf-8")) <= MAX_LINE_BYTES:
+            send_queue.append((msg, self.log))
+        elif colon and command in {"NOTICE", "PRIVMSG"} and \
+                len(head.encode("utf-8")) + 2 < MAX_LINE_BYTES - 4:
+            for piece in split_utf8(text, MAX_LINE_BYTES
+                                    - len(head.encode("utf-8")) - 2):
+                send_queue.append((head + " :" + piece, self.log))
+        else:
+            say("TRUNCATED TOO LONG LINE TO SERVER: " + msg)
+            send_queue.append((split_utf8(msg, MAX_LINE_BYTES)[0], self.log))
+        self.send_ready.set()
+
+    def _next_line(self):
+
+        # Merge NOTICEs queued up for the same target as far as they fit into
+        # one line.
+        for send_queue in self.send_queues:
+            if len(send_queue) > 0:
+                break
+        msg, log = send_queue.popleft()
+        if msg[:7] == "NOTICE " and " :" in msg:
+            head = msg[:msg.find(" :") + 2]
+            size = len(msg.encode("utf-8"))
+            while len(send_queue) > 0 and \
+                    send_queue[0][0].startswith(head) and \
+                    send_queue[0][1] == log:
+                text = send_queue[0][0][len(head):]
+                text_size = len((NOTICE_JOINER + text).encode("utf-8"))
+                if size + text_size > MAX_LINE_BYTES:
+                    break
+                msg += NOTICE_JOINER + text
+                size += text_size
+                send_queue.popleft()
+        return msg, log
+
+    async def _take_send_token(self):
+        if self.send_rate <= 0:
+            return
         while True:
-            ready = select.select([self.socket], [], [], int(self.timeout / 2))
-            if not ready[0]:
-                self._pingtest(send_ping)
-                return None
-            self.last_pong = time.time()
-            received_bytes = self.socket.recv(1024)
-            try:
-                received_runes = received_bytes.decode("UTF-8")
-            except UnicodeDecodeError:
-                received_runes = received_bytes.decode("latin1")
-            if len(received_runes) == 0:
-                print("SOCKET CONNECTION BROKEN")
-                raise ExceptionForRestart
-            self.rune_buffer += received_runes
-            lines_split = str.split(self.rune_buffer, "\r\n")
-            self.line_buffer += lines_split[:-1]
-            self.rune_buffer = lines_split[-1]
-            if len(self.line_buffer) > 0:
-                return self.line_buffer.pop(0)
-
-    def recv_line(self, send_ping=True):
-        line = self._recv_line_wrapped(send_ping)
-        if line:
-            if self.log != None:
-                self.log.log(line)
-            print("LINE FROM SERVER " + str(datetime.datetime.now()) + ": " +
-                  line)
+            now = time.time()
+            self.send_tokens = min(self.send_burst, self.send_tokens +
+                                   (now - self.send_time) * self.send_rate)
+            self.send_time = now
+            if self.send_tokens >= 1:
+                self.send_tokens -= 1
+                return
+            await asyncio.sleep((1 - self.send_tokens) / self.send_rate)
+
+    async def _send_loop(self):
+
+        # Drain the send queues through a token bucket of send_burst lines,
+        # refilled by send_rate lines per second.
+        while not self.broken:
+            if not any(self.send_queues):
+                self.send_ready.clear()
+                await self.send_ready.wait()
+                continue
+            await self._take_send_token()
+            await self.can_write.wait()
+            if self.broken:
+                break
+            msg, log = self._next_line()
+            say("LINE TO SERVER: " + str(datetime.datetime.now()) + ": " + msg,
+                "lines")
+            if log != None:
+                log.log(irclog.Line(msg), True)
+            data = bytes(msg + "\r\n", "UTF-8")
+            self.transport.write(data)
+            plommetrics.inc("lines_sent")
+            plommetrics.inc("bytes_sent", len(data))
+
+    async def drain(self):
+        await self.can_write.wait()
+        if self.broken:
+            raise ExceptionForRestart
+
+    async def send_line(self, msg):
+        self.write_line(msg)
+        await self.drain()
+
+    async def _recv_line_wrapped(self):
+        if len(self.line_buffer) > 0:
+            return self.line_buffer.popleft()
+        if self.broken:
+            raise ExceptionForRestart
+        self.ready.clear()
+        try:
+            await asyncio.wait_for(self.ready.wait(), self.timeout / 2)
+        except asyncio.TimeoutError:
+            pass
+        if len(self.line_buffer) > 0:
+            return self.line_buffer.popleft()
+        if self.broken:
+            raise ExceptionForRestart
+        return None
+
+    async def recv_line(self):
+        line = await self._recv_line_wrapped()
+        if not line:
+            return None
+        plommetrics.inc("lines_received")
+        say("LINE FROM SERVER " + str(datetime.datetime.now()) + ": " + line,
+            "lines")
+        line = irclog.Line(line)
+        if self.log != None:
+            self.log.log(line)
         return line
 
 
-def handle_command(command, argument, notice, target, session):
+class QuoteStore:
+
+    def __init__(self, path, channel):
+        self.path = path
+        self.index_path = path + ".index"
+        self.channel = channel
+        self.offsets = array.array("Q")
+        self.stat = None
+        self.lines = None
+        self.search_index = None
+        self.search_corpus = None
+        self._load_index()
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def _load_index(self):
+
+        # Index file: size and mtime of the quotes file it describes, then
+        # the start offset of each of its lines (header line included).
+        stat = self._file_stat()
+        if stat is None:
+            return
+        try:
+            f = open(self.index_path, "rb")
+            data = f.read()
+            f.close()
+        except OSError:
+            return
+        if len(data) < 16 or (len(data) - 16) % 8 != 0 or \
+                struct.unpack("=QQ", data[:16]) != stat:
+            return
+        self.offsets.frombytes(data[16:])
+        self.stat = stat
+
+    def _save_index(self, appended_from):
+        header = struct.pack("=QQ", *self.stat)
+        try:
+            index_size = os.path.getsize(self.index_path)
+        except OSError:
+            index_size = -1
+        if appended_from > 0 and index_size == 16 + 8 * appended_from:
+            f = open(self.index_path, "r+b")
+            f.write(header)
+            f.seek(index_size)
+            f.write(self.offsets[appended_from:].tobytes())
+        else:
+            f = open(self.index_path, "wb")
+            f.write(header + self.offsets.tobytes())
+        f.close()
+
+    def _refresh(self):
+        stat = self._file_stat()
+        if stat == self.stat:
+            return
+        if stat is None:
+            self.offsets = array.array("Q")
+            self.stat = None
+            self.lines = None
+            self.search_index = None
+            self.search_corpus = None
+            return
+        f = open(self.path, "rb")
+        start = 0
+        if self.stat is not None and stat[0] > self.stat[0]:
+            f.seek(self.stat[0] - 1)
+            if f.read(1) == b"\n":
+                start = self.stat[0]
+        if start == 0:
+            self.offsets = array.array("Q")
+            self.lines = None
+            self.search_index = None
+            self.search_corpus = None
+        appended_from = len(self.offsets)
+        f.seek(start)
+        data = f.read(stat[0] - start)
+        f.close()
+        if len(data) > 0:
+            self.offsets.append(start)
+        pos = data.find(b"\n")
+        while pos >= 0 and pos + 1 < len(data):
+            self.offsets.append(start + pos + 1)
+            pos = data.find(b"\n", pos + 1)
+        if self.lines is not None:
+            for line in split_lines(data.decode("utf-8", "replace")):
+                self.lines += [line]
+                if self.search_index is not None:
+                    self.search_index.add(line)
+                    self.search_corpus.add(line)
+        self.stat = stat
+        self._save_index(appended_from)
+
+    def count(self):
+        self._refresh()
+        return max(len(self.offsets) - 1, 0)
+
+    def get(self, i):
+        self._refresh()
+        if self.lines is not None:
+            return self.lines[i]
+        f = open(self.path, "rb")
+        f.seek(self.offsets[i + 1])
+        line = f.readline()
+        f.close()
+        return line.decode("utf-8", "replace")
+
+    def all(self):
+        self._refresh()
+        if self.lines is None:
+            f = open(self.path, "rb")
+            text = f.read(self.stat[0]).decode("utf-8", "replace")
+            f.close()
+            self.lines = split_lines(text)[1:]
+        return self.lines
+
+    def search(self, query):
+        lines = self.all()
+        if self.search_index is None:
+            self.search_index = plomsearch.SearchIndex(lines)
+            self.search_corpus = plomsearch.BatchCorpus(lines)
+        with plommetrics.timer("search"):
+            return plomsearch.search(query, lines, self.search_index,
+                                     self.search_corpus)
+
+    def add(self, quote):
+        if not os.access(self.path, os.F_OK):
+            write_to_file(self.path, "w", "QUOTES FOR " + self.channel + ":\n")
+        write_to_file(self.path, "a", quote + "\n")
+        return self.count()
+
+
+@plommetrics.timed("handle_command")
+def handle_command(command, argument, notice, target, session, channel,
+                   source=None):
 
     def addquote():
-        if not os.access(session.quotesfile, os.F_OK):
-            write_to_file(session.quotesfile, "w",
-                          "QUOTES FOR " + target + ":\n")
-        write_to_file(session.quotesfile, "a", argument + "\n")
-        quotesfile = open(session.quotesfile, "r")
-        lines = quotesfile.readlines()
-        quotesfile.close()
-        notice("added quote #" + str(len(lines) - 1))
+        notice("added quote #" + str(channel.quotes.add(argument)))
 
     def quote():
 
@@ -221,16 +503,13 @@ def handle_command(command, argument, notice, target, session):
              ((not len(tokens) > 2) or (not tokens[1].isdigit()))))):
             help()
             return
-        if not os.access(session.quotesfile, os.F_OK):
+        count = channel.quotes.count()
+        if count == 0:
             notice("no quotes available")
             return
-        quotesfile = open(session.quotesfile, "r")
-        lines = quotesfile.readlines()
-        quotesfile.close()
-        lines = lines[1:]
         if len(tokens) == 1:
             i = int(tokens[0])
-            if i == 0 or i > len(lines):
+            if i == 0 or i > count:
                 notice("there's no quote of that index")
                 return
             i = i - 1
@@ -242,7 +521,7 @@ def handle_command(command, argument, notice, target, session):
                 to_skip = int(tokens[1])
                 query = str.join(" ", tokens[2:])
             try:
-                results = plomsearch.search(query, lines)
+                results = channel.quotes.search(query)
             except plomsearch.LogicParserError as err:
                 notice("failed query parsing: " + str(err))
                 return
@@ -261,126 +540,72 @@ def handle_command(command, argument, notice, target, session):
                                + result[1][:-1])
             return
         else:
-            i = random.randrange(len(lines))
-        notice("quote #" + str(i + 1) + ": " + lines[i][:-1])
+            i = random.randrange(count)
+        notice("quote #" + str(i + 1) + ": " + channel.quotes.get(i)[:-1])
 
     def markov():
 
         def help():
-            notice("syntax: !markov [integer from 1 to infinite]")
-
-        def markov(snippet):
-            usable_selections = []
-            for i in range(select_length, 0, -1):
-                for selection in selections:
-                    add = True
-                    for j in range(i):
-                        j += 1
-                        if snippet[-j] != selection[-(j+1)]:
-                            add = False
-                            break
-                    if add:
-                        usable_selections += [selection]
-                if [] != usable_selections:
-                    break
-            if [] == usable_selections:
-                usable_selections = selections
-            selection = choice(usable_selections)
-            return selection[select_length]
+            notice("syntax: !markov [about WORD] [integer from 1 to "
+                   + str(plommarkov.MAX_ORDER) + "]")
 
         if "" == argument:
             tokens = []
         else:
             tokens = argument.split(" ")
+        word = None
+        if len(tokens) > 1 and tokens[0] == "about":
+            word = tokens[1]
+            tokens = tokens[2:]
         if (len(tokens) > 1 or (len(tokens) == 1 and not tokens[0].isdigit())):
             help()
             return
 
-        from random import choice, shuffle
         select_length = 2
         if len(tokens) == 1:
             n = int(tokens[0])
-            if n > 0:
+            if n > plommarkov.MAX_ORDER:
+                select_length = plommarkov.MAX_ORDER
+                notice("value too high, using maximum: " + str(select_length))
+            elif n > 0:
                 select_length = n
             else:
                 notice("bad value, using default: " + str(select_length))
-        selections = []
 
-        if not os.access(session.markovfile, os.F_OK):
+        if not os.access(channel.markovfile, os.F_OK):
             notice("not enough text to markov for selection length")
             return
-
-        # Lowercase incoming lines, ensure they end in a sentence end mark.
-        file = open(session.markovfile, "r")
-        lines = file.readlines()
-        file.close()
-        tokens = []
-        sentence_end_markers = ".!?)("
-        for line in lines:
-            line = line.lower().replace("\n", "")
-            if line[-1] not in sentence_end_markers:
-                line += "."
-            tokens += line.split()
-        if len(tokens) - 1 <= select_length:
+        model = plommarkov.get_model(channel.markovfile)
+        if len(model.tokens) - 1 <= select_length:
             notice("not enough text to markov")
             return
 
-        # Replace URLs with escape string for now, so that the Markov selector
-        # won't see them as different strings. Stash replaced URLs in urls.
-        urls = []
-        url_escape = "\nURL"
-        url_starts = ["http://", "https://", "<http://", "<https://"]
-        for i in range(len(tokens)):
-            for url_start in url_starts:
-                if tokens[i][:len(url_start)] == url_start:
-                    length = len(tokens[i])
-                    if url_start[0] == "<":
-                        try:
-                            length = tokens[i].index(">") + 1
-                        except ValueError:
-                            pass
-                    urls += [tokens[i][:length]]
-                    tokens[i] = url_escape + tokens[i][length:]
-                    break
+        # Start with word, led up to by what came before it in the feed.
+        start = None
+        if word != None:
+            with plommetrics.timer("markov_about"):
+                start = model.about(word, select_length, 100)
+            if start == None:
+                notice("no text about " + word + " to markov")
+                return
 
-        # For each snippet of select_length, use markov() to find continuation
-        # token from selections. Replace present users' names with malkovich.
-        # Start snippets with the beginning of a sentence, if possible.
-        for i in range(len(tokens) - select_length):
-            token_list = []
-            for j in range(select_length + 1):
-                token_list += [tokens[i + j]]
-            selections += [token_list]
-        snippet = []
-        for i in range(select_length):
-            snippet += [""]
-        shuffle(selections)
-        for i in range(len(selections)):
-            if selections[i][0][-1] in sentence_end_markers:
-                for j in range(select_length):
-                    snippet[j] = selections[j][j + 1]
-                break
+        # Replace present users' names with malkovich.
         msg = ""
         malkovich = "malkovich"
-        while 1:
-            new_end = markov(snippet)
-            for name in session.users_in_chan:
-                if new_end[:len(name)] == name.lower():
-                    new_end = malkovich + new_end[len(name):]
+        with plommetrics.timer("markov"):
+            for new_end in model.generate(select_length, start):
+                new_end = channel.mask_names(new_end, malkovich)
+                if len(msg) + len(new_end) > 200:
                     break
-            if len(msg) + len(new_end) > 200:
-                break
-            msg += new_end + " "
-            for i in range(select_length - 1):
-                snippet[i] = snippet[i + 1]
-            snippet[select_length - 1] = new_end
+                msg += new_end + " "
 
         # Replace occurences of url escape string with random choice from urls.
         while True:
-            index = msg.find(url_escape)
+            index = msg.find(plommarkov.URL_ESCAPE)
             if index < 0:
                 break
-            msg = msg.replace(url_escape, choice(urls), 1)
+            msg = msg.replace(plommarkov.URL_ESCAPE,
+                              random.choice(model.urls), 1)
 
         # More meaningful ways to randomly end sentences.
         notice(msg + malkovich + ".")
@@ -407,17 +632,89 @@ def handle_command(command, argument, notice, target, session):
         twtfile.close()
         notice("wrote twt.")
 
-    if "addquote" == command:
-        addquote()
-    elif "quote" == command:
-        quote()
-    elif "markov" == command:
-        markov()
-    elif "twt" == command:
-        twt()
+    def stats():
+        if not session.is_owner(source):
+            notice("!stats is for the bot owner only")
+            return
+        registry = plommetrics.registry
+        notice("lines in/out: " + str(registry.value("lines_received")) + "/"
+               + str(registry.value("lines_sent")) + ", bytes in/out: "
+               + str(registry.value("bytes_received")) + "/"
+               + str(registry.value("bytes_sent")) + ", reconnects: "
+               + str(registry.value("reconnects")))
+        notice("url fetches: " + str(registry.value("url_fetches"))
+               + ", url cache hits/misses: "
+               + str(registry.value("url_cache_hits")) + "/"
+               + str(registry.value("url_cache_misses")) + ", commands: "
+               + str.join(" ", [name + "=" + str(n) for name, n in
+                                sorted(registry.labelled("commands",
+                                                         "command").items())]))
+        latencies = registry.latencies()
+        notice("latencies (n, avg, p95): " + str.join(", ", [
+            operation + " " + str(histogram.count) + " "
+            + "%.2fms" % (1000 * histogram.sum / histogram.count) + " <"
+            + "%gms" % (1000 * histogram.quantile(0.95))
+            for operation, histogram in sorted(latencies.items())
+            if histogram.count > 0]))
+
+    commands = {"addquote": addquote, "quote": quote, "markov": markov,
+                "twt": twt, "stats": stats}
+    if command in commands:
+        plommetrics.inc("commands", command=command)
+        commands[command]()
+
+
+class TitleParser(html.parser.HTMLParser):
 
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.og_title = None
+        self.done = False
+        self._in_title = False
+        self._title_parts = []
 
-def handle_url(url, notice, show_url=False):
+    def handle_starttag(self, tag, attrs):
+        if tag == "title" and self.title is None:
+            self._in_title = True
+        elif tag == "meta":
+            attrs = dict(attrs)
+            if attrs.get("property") == "og:title" and attrs.get("content"):
+                self.og_title = attrs["content"]
+                self.done = True
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self._in_title:
+            self._in_title = False
+            self.title = str.join("", self._title_parts)
+            self.done = True
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts += [data]
+
+
+def sniff_charset(content_type, head):
+    charset = "utf-8"
+    m = re.search("charset=[\"']?([\\w.:-]+)", content_type, re.I)
+    if m:
+        charset = m.group(1)
+    else:
+        m = re.search(b"<meta[^>]+charset=[\"']?([\\w.:-]+)", head, re.I)
+        if m:
+            charset = m.group(1).decode("ascii")
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return "utf-8"
+
+
+@plommetrics.timed("handle_url")
+def handle_url(url, notice, fetcher, show_url=False):
 
     def mobile_twitter_hack(url):
         re1 = 'https?://(mobile.twitter.com/)[^/]+(/status/)'
@@ -426,121 +723,405 @@ def handle_url(url, notice, show_url=False):
         if m and m.group(1) == 'mobile.twitter.com/' \
                 and m.group(2) == '/status/':
             m = re.search(re2, url)
-            url = 'https://twitter.com/' + m.group(1) + '/status/' + m.group(2)
-            handle_url(url, notice, True)
-            return True
+            return 'https://twitter.com/' + m.group(1) + '/status/' + m.group(2)
 
-    class TimeOut(Exception):
-        pass
+    twitter_url = mobile_twitter_hack(url)
+    if twitter_url:
+        return handle_url(twitter_url, notice, fetcher, True)
 
-    def timeout_handler(ignore1, ignore2):
-        raise TimeOut("timeout")
-
-    signal.signal(signal.SIGALRM, timeout_handler)
-    signal.alarm(15)
+    # Read the body in chunks only as far as needed to find a title.
+    deadline = time.time() + fetcher.timeout
+    parser = TitleParser()
     try:
-        r = requests.get(url, headers = {'User-Agent': 'plomlombot'}, stream=True)
-        r.raw.decode_content = True
-        text = r.raw.read(10000000+1)
-        if len(text) > 10000000:
-            raise ValueError('Too large a response')
+        with fetcher.get(url, deadline) as r:
+            content_type = r.headers.get("Content-Type", "")
+            if content_type and \
+                    content_type.split(";")[0].strip().lower() not in \
+                    {"text/html", "application/xhtml+xml"}:
+                notice("page has no title tag (content type: "
+                       + content_type.split(";")[0].strip() + ")")
+                return False
+            head = b""
+            decoder = None
+            for chunk in fetcher.iter_body(r, deadline, URL_CHUNK_SIZE):
+                if decoder is None:
+                    head += chunk
+                    if len(head) < 1024:
+                        continue
+                    charset = sniff_charset(content_type, head)
+                    decoder = codecs.getincrementaldecoder(charset)("replace")
+                    chunk = head
+                parser.feed(decoder.decode(chunk))
+                if parser.done:
+                    break
+            else:
+                if decoder is None:
+                    charset = sniff_charset(content_type, head)
+                    decoder = codecs.getincrementaldecoder(charset)("replace")
+                    parser.feed(decoder.decode(head))
+                parser.feed(decoder.decode(b"", True))
     except (requests.exceptions.TooManyRedirects,
             requests.exceptions.ConnectionError,
             requests.exceptions.InvalidURL,
-            TimeOut,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.ContentDecodingError,
+            plomfetch.FetchTimeout,
             UnicodeError,
             ValueError,
             requests.exceptions.InvalidSchema) as error:
-        signal.alarm(0)
         notice("trouble following url: " + str(error))
         return False
-    signal.alarm(0)
-    if mobile_twitter_hack(url):
-        return True
-    title = bs4.BeautifulSoup(text, "html5lib").title
-    if title and title.string:
+    title = parser.title
+    if not title or not title.strip():
+        title = parser.og_title
+    if title and title.strip():
         prefix = "page title: "
         if show_url:
             prefix = "page title for <" + url + ">: "
-        notice(prefix + title.string.strip())
-    else:
-        notice("page has no title tag")
-    return True
+        notice(prefix + str.join(" ", title.split()))
+        return True
+    notice("page has no title tag")
+    return False
+
+
+class URLTitleCache:
+
+    def __init__(self, path, size, ttl, repeat_mute):
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = min(ttl, URL_CACHE_NEGATIVE_TTL)
+        self.repeat_mute = repeat_mute * 60
+        self.entries = collections.OrderedDict()
+        self.posted = {}
+        self.last_save = time.time()
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def normalize(url):
+        m = re.search('https?://mobile.twitter.com/([^/]+)/status/([^\?/]+)',
+                      url)
+        if m:
+            url = 'https://twitter.com/' + m.group(1) + '/status/' + m.group(2)
+        parts = urllib.parse.urlsplit(url)
+        return urllib.parse.urlunsplit((parts.scheme.lower(),
+                                        parts.netloc.lower(),
+                                        parts.path or "/", parts.query, ""))
+
+    def load(self):
+        try:
+            f = open(self.path, "r")
+            entries = json.load(f)
+            f.close()
+        except (OSError, ValueError):
+            return
+        if self.size < 1:
+            return
+        now = time.time()
+        for url, expiry, msgs in entries[-self.size:]:
+            if expiry > now:
+                self.entries[url] = (expiry, msgs)
+
+    def save(self, force=False):
+        if not self.dirty or \
+                (not force and self.last_save + URL_CACHE_SAVE_INTERVAL >
+                 time.time()):
+            return
+        entries = [[url, expiry, msgs]
+                   for url, (expiry, msgs) in self.entries.items()]
+        try:
+            f = open(self.path + ".tmp", "w")
+            json.dump(entries, f)
+            f.close()
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as error:
+            say("CAN'T WRITE URL TITLE CACHE: " + str(error))
+        self.last_save = time.time()
+        self.dirty = False
+
+    def get(self, url):
+        entry = self.entries.get(url)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del self.entries[url]
+            self.dirty = True
+            return None
+        self.entries.move_to_end(url)
+        return entry[1]
+
+    def put(self, url, msgs, found):
+        if self.size < 1:
+            return
+        ttl = self.ttl if found else self.negative_ttl
+        self.entries[url] = (time.time() + ttl, msgs)
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        self.dirty = True
+
+    def repeated(self, network, target, url):
+        if self.repeat_mute < 1:
+            return False
+        now = time.time()
+        if len(self.posted) > max(self.size, 1000):
+            for key in [key for key, posted in self.posted.items()
+                        if posted + self.repeat_mute < now]:
+                del self.posted[key]
+        last = self.posted.get((network, target, url))
+        self.posted[(network, target, url)] = now
+        return last is not None and last + self.repeat_mute > now
+
+
+class URLTitlePool:
+
+    def __init__(self, workers, cache, fetcher):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self.cache = cache
+        self.fetcher = fetcher
+
+    def submit(self, url, network, target, deliver):
+
+        # Results are handed to deliver(target, msgs) in the event loop.
+        # Repeats are muted per network and target.
+        def work():
+            msgs = []
+            found = False
+            plommetrics.inc("url_fetches")
+            try:
+                found = handle_url(url, msgs.append, self.fetcher)
+            except Exception as error:
+                msgs += ["trouble following url: " + str(error)]
+            loop.call_soon_threadsafe(self._finish, deliver, target, msgs,
+                                      key, found)
+
+        loop = asyncio.get_running_loop()
+        key = self.cache.normalize(url)
+        if self.cache.repeated(network, irclog.casefold(target), key):
+            return
+        msgs = self.cache.get(key)
+        if msgs is not None:
+            plommetrics.inc("url_cache_hits")
+            loop.call_soon(deliver, target, msgs)
+            return
+        plommetrics.inc("url_cache_misses")
+        self.executor.submit(work)
+
+    def _finish(self, deliver, target, msgs, key, found):
+        self.cache.put(key, msgs, found)
+        self.cache.save()
+        deliver(target, msgs)
+
+
+class Channel:
+
+    def __init__(self, name, dbdir, nickname, username, rmlogs, log_fsync,
+                 log_compress, schedule=None):
+        self.name = name
+        self.users = {}
+        self.masking = None
+        hash_channel = hashlib.md5(name.encode("utf-8")).hexdigest()
+        chandir = dbdir + "/" + hash_channel + "/"
+        self.markovfile = chandir + "markovfeed"
+        self.quotes = QuoteStore(chandir + "quotes", name)
+        self.log = irclog.Log(chandir, nickname, username, name, rmlogs,
+                              log_fsync, log_compress, say, schedule)
+
+    def add_user(self, nick):
+        self.users[irclog.casefold(nick)] = nick
+        self.masking = None
+
+    def remove_user(self, nick):
+        if self.users.pop(irclog.casefold(nick), None) == None:
+            return False
+        self.masking = None
+        return True
+
+    def clear_users(self):
+        self.users = {}
+        self.masking = None
+
+    def mask_names(self, token, mask):
+
+        # Replace a present user's name starting (lowercase) token with mask.
+        # Test the token's prefixes against a set of the names, one per
+        # distinct name length, longest first.
+        if self.masking == None:
+            names = {nick.lower() for nick in self.users.values()}
+            lengths = sorted({len(name) for name in names if name},
+                             reverse=True)
+            self.masking = (names, lengths)
+        names, lengths = self.masking
+        for length in lengths:
+            if token[:length] in names:
+                return mask + token[length:]
+        return token
+
+
+class ChannelsLog:
+
+    # Routes lines to the Log of the channel they're addressed to, received
+    # QUITs and NICKs to the Logs of the channels their sender is in (so this
+    # must run before the users get updated), anything else to all channels'
+    # Logs.
+
+    def __init__(self, channels):
+        self.channels = channels
+
+    def _logs(self, line, sent):
+        if line.command in {"QUIT", "NICK"} and not sent:
+            nick = irclog.casefold(line.sender)
+            return [channel.log for channel in self.channels.values()
+                    if nick in channel.users]
+        channel = self.channels.get(irclog.casefold(line.receiver))
+        if channel != None:
+            return [channel.log]
+        return [channel.log for channel in self.channels.values()]
+
+    def log(self, line, sent=False):
+        for log in self._logs(line, sent):
+            log.log(line, sent)
+
+    def rmlogs(self):
+        for channel in self.channels.values():
+            channel.log.rmlogs()
+
+    def flush_if_due(self):
+        for channel in self.channels.values():
+            channel.log.flush_if_due()
+
+    def separator_line(self):
+        for channel in self.channels.values():
+            channel.log.separator_line()
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.log.close()
 
 
 class Session:
 
-    def __init__(self, io, username, nickname, channel, twtfile, dbdir, rmlogs,
-                 markov_input):
+    def __init__(self, io, server, username, nickname, channels, twtfile,
+                 dbdir, rmlogs, markov_input, url_titles, log_fsync=LOG_FSYNC,
+                 log_compress="none", owner=None):
         self.io = io
+        self.server = server
+        self.owner = owner
+        self.url_titles = url_titles
         self.nickname = nickname
-        self.users_in_chan = []
         self.twtfile = twtfile
-        hash_channel = hashlib.md5(channel.encode("utf-8")).hexdigest()
-        chandir = dbdir + "/" + hash_channel + "/"
         self.markov_input = markov_input
-        self.markovfile = chandir + "markovfeed"
-        self.quotesfile = chandir + "quotes"
-        self.log = Log(chandir, self.nickname, username, channel, rmlogs)
-        self.io.send_line("NICK " + self.nickname)
-        self.io.send_line("USER " + username + " 0 * : ")
-        self.io.send_line("JOIN " + channel)
+        self.channels = {}
+        for name in channels:
+            self.channels[irclog.casefold(name)] = Channel(
+                name, dbdir, self.nickname, username, rmlogs, log_fsync,
+                log_compress, asyncio.get_running_loop().call_later)
+        self.default_channel = self.channels[irclog.casefold(channels[0])]
+        self.log = ChannelsLog(self.channels)
+        self.io.write_line("NICK " + self.nickname)
+        self.io.write_line("USER " + username + " 0 * : ")
+        for name in channels:
+            self.io.write_line("JOIN " + name)
         self.io.log = self.log
         self.log.separator_line()
 
-    def loop(self):
+    def is_owner(self, source):
+
+        # The owner may be given as nick or as full nick!user@host.
+        if self.owner == None or source == None:
+            return False
+        if "!" not in self.owner:
+            source = source.partition("!")[0]
+        return irclog.casefold(source) == irclog.casefold(self.owner)
+
+    def deliver_url_titles(self, target, msgs):
+        try:
+            for msg in msgs:
+                self.io.write_line("NOTICE " + target + " :" + msg)
+        except ExceptionForRestart:
+            pass
+
+    async def loop(self):
+
+        def is_self(nick):
+            return irclog.casefold(nick) == irclog.casefold(self.nickname)
 
         def handle_privmsg(line):
 
             def notice(msg):
                 line = "NOTICE " + target + " :" + msg
-                self.io.send_line(line)
+                self.io.write_line(line)
 
             target = line.sender
-            if line.receiver != self.nickname:
+            if not is_self(line.receiver):
                 target = line.receiver
-            msg = str.join(" ", line.tokens[3:])[1:]
+            channel = self.channels.get(irclog.casefold(line.receiver),
+                                        self.default_channel)
+            if len(line.params) < 2 or line.params[1] == "":
+                return
+            msg = line.params[1]
             matches = re.findall("(https?://[^\s>]+)", msg)
-            url_count = 0
             for i in range(len(matches)):
-                if handle_url(matches[i], notice):
-                    url_count += 1
-                    if url_count == 3:
-                        notice("maximum number of urls to parse per message "
-                               "reached")
-                        break
+                if i == 3:
+                    notice("maximum number of urls to parse per message "
+                           "reached")
+                    break
+                self.url_titles.submit(matches[i], self.server, target,
+                                       self.deliver_url_titles)
             if "!" == msg[0] and len(msg) > 1:
                 tokens = msg[1:].split()
                 argument = str.join(" ", tokens[1:])
-                handle_command(tokens[0], argument, notice, target, self)
+                handle_command(tokens[0], argument, notice, target, self,
+                               channel, line.prefix)
                 return
             if self.markov_input:
-                write_to_file(self.markovfile, "a", msg + "\n")
+                write_to_file(channel.markovfile, "a", msg + "\n")
+                plommarkov.sync_model(channel.markovfile)
 
         while True:
             self.log.rmlogs()
-            line = self.io.recv_line()
-            if not line:
+            self.log.flush_if_due()
+            await self.io.drain()
+            line = await self.io.recv_line()
+            if line == None:
                 continue
-            line = Line(line)
-            if len(line.tokens) > 1:
-                if line.tokens[0] == "PING":
-                    self.io.send_line("PONG " + line.tokens[1])
-                elif line.tokens[1] == "PRIVMSG":
-                    handle_privmsg(line)
-                elif line.tokens[1] == "353":
-                    names = line.tokens[5:]
-                    names[0] = names[0][1:]
-                    for i in range(len(names)):
-                        names[i] = names[i].replace("@", "").replace("+", "")
-                    self.users_in_chan += names
-                elif line.tokens[1] == "JOIN" and line.sender != self.nickname:
-                    self.users_in_chan += [line.sender]
-                elif line.tokens[1] == "PART":
-                    del(self.users_in_chan[self.users_in_chan.index(line.sender)])
-                elif line.tokens[1] == "NICK":
-                    del(self.users_in_chan[self.users_in_chan.index(line.sender)])
-                    self.users_in_chan += [line.receiver]
+            command = line.command
+            if command == "PING":
+                self.io.write_line("PONG " + line.param_string)
+            elif command == "PRIVMSG":
+                handle_privmsg(line)
+            elif command == "353" and len(line.params) > 3 and \
+                    irclog.casefold(line.params[2]) in self.channels:
+                channel = self.channels[irclog.casefold(line.params[2])]
+                for nick in line.params[3].split():
+                    channel.add_user(nick.lstrip("~&@%+"))
+            elif command == "JOIN":
+                for name in irclog.casefold(line.receiver).split(","):
+                    if name in self.channels:
+                        if is_self(line.sender):
+                            self.channels[name].clear_users()
+                        else:
+                            self.channels[name].add_user(line.sender)
+            elif command == "PART":
+                for name in irclog.casefold(line.receiver).split(","):
+                    if name in self.channels:
+                        self.channels[name].remove_user(line.sender)
+            elif command == "KICK" and len(line.params) > 1:
+                names = irclog.casefold(line.params[0]).split(",")
+                nicks = line.params[1].split(",")
+                for i in range(len(names)):
+                    if names[i] in self.channels:
+                        self.channels[names[i]].remove_user(
+                            nicks[min(i, len(nicks) - 1)])
+            elif command == "QUIT":
+                for channel in self.channels.values():
+                    channel.remove_user(line.sender)
+            elif command == "NICK":
+                for channel in self.channels.values():
+                    if channel.remove_user(line.sender):
+                        channel.add_user(line.receiver)
 
 
 def parse_command_line_arguments():
@@ -570,24 +1151,181 @@ def parse_command_line_arguments():
     parser.add_argument("-r, --rmlogs", action="store", dest="rmlogs",
                         type=int, default=0,
                         help="maximum age in seconds for logfiles in logs/ "
-                        "(0 means: never delete, and is default)")
+                        "and raw_logs/ (0 means: never delete, and is "
+                        "default)")
     parser.add_argument("-m, --markov_store", action="store_true",
                         dest="markov_store",
                         help="log channel discussions for !markov input")
-    parser.add_argument("CHANNEL", action="store", help="channel to join")
+    parser.add_argument("-c, --url_cache", action="store",
+                        dest="url_cache_size", type=int,
+                        default=URL_CACHE_SIZE,
+                        help="maximum number of url titles to cache (0 means: "
+                        "don't cache; default: " + str(URL_CACHE_SIZE) + ")")
+    parser.add_argument("-e, --url_cache_ttl", action="store",
+                        dest="url_cache_ttl", type=int, default=URL_CACHE_TTL,
+                        help="seconds after which cached url titles expire "
+                        "(default: " + str(URL_CACHE_TTL) + ")")
+    parser.add_argument("-q, --url_quiet", action="store",
+                        dest="url_quiet", type=int, default=0,
+                        help="minutes within which a url posted again to the "
+                        "same target on the same network gets no new title "
+                        "notice (0 means: always notice, and is default)")
+    parser.add_argument("-f, --log_fsync", action="store", dest="log_fsync",
+                        choices=["never", "flush", "always"],
+                        default=LOG_FSYNC,
+                        help="when to fsync log files: never, on each "
+                        "(periodic) flush, or always after each line "
+                        "(default: " + LOG_FSYNC + ")")
+    parser.add_argument("-z, --compress_logs", action="store",
+                        dest="compress_logs",
+                        choices=["none"] + list(irclog.COMPRESSION_SUFFIXES),
+                        default="none",
+                        help="compress log files of past days with gzip or "
+                        "zstd (the latter needs the zstandard module; "
+                        "default: none)")
+    parser.add_argument("-R, --send_rate", action="store", dest="send_rate",
+                        type=float, default=SEND_RATE,
+                        help="lines per second to send to the server once a "
+                        "burst is used up (0 means: no limit; default: "
+                        + str(SEND_RATE) + ")")
+    parser.add_argument("-b, --send_burst", action="store",
+                        dest="send_burst", type=int, default=SEND_BURST,
+                        help="lines to send to the server in a burst "
+                        "(default: " + str(SEND_BURST) + ")")
+    parser.add_argument("-o, --owner", action="store", dest="owner",
+                        default=None,
+                        help="nick or nick!user@host of the bot's owner, who "
+                        "alone may use !stats")
+    parser.add_argument("-v, --verbosity", action="store", dest="verbosity",
+                        choices=VERBOSITIES, default=VERBOSITY,
+                        help="what to print to stdout: quiet, info, or "
+                        "lines, which adds every line from and to the "
+                        "server (default: " + VERBOSITY + ")")
+    parser.add_argument("-M, --metrics_socket", action="store",
+                        dest="metrics_socket", default=None,
+                        help="unix socket to serve Prometheus-style metrics "
+                        "on")
+    parser.add_argument("-F, --metrics_file", action="store",
+                        dest="metrics_file", default=None,
+                        help="file to write Prometheus-style metrics to every "
+                        + str(METRICS_INTERVAL) + " seconds")
+    parser.add_argument("-l, --channel_list", action="store",
+                        dest="channel_list", default=None,
+                        help="file listing further channels to join, one per "
+                        "line")
+    parser.add_argument("-N, --network_list", action="store",
+                        dest="network_list", default=None,
+                        help="file listing further networks to connect to, "
+                        "one per line as: SERVER[:PORT] CHANNEL [CHANNEL ...]")
+    parser.add_argument("CHANNEL", action="store", nargs="*",
+                        help="channel(s) to join on --server")
     opts, unknown = parser.parse_known_args()
+    if opts.channel_list != None:
+        try:
+            f = open(opts.channel_list, "r")
+            opts.CHANNEL += [line.strip() for line in f if line.strip()]
+            f.close()
+        except OSError as err:
+            parser.error("can't read channel list: " + str(err))
+    opts.networks = []
+    if len(opts.CHANNEL) > 0:
+        opts.networks += [(opts.server, opts.port, opts.CHANNEL)]
+    if opts.network_list != None:
+        try:
+            f = open(opts.network_list, "r")
+            lines = f.readlines()
+            f.close()
+        except OSError as err:
+            parser.error("can't read network list: " + str(err))
+        for line in lines:
+            tokens = line.split()
+            if len(tokens) == 0:
+                continue
+            server, _, port = tokens[0].partition(":")
+            if len(tokens) < 2 or (port and not port.isdigit()):
+                parser.error("bad network list line: " + line.strip())
+            opts.networks += [(server, int(port) if port else PORT,
+                               tokens[1:])]
+    if len(opts.networks) == 0:
+        parser.error("no channel to join given")
+    if opts.compress_logs == "zstd" and irclog.zstandard == None:
+        parser.error("zstd log compression needs the zstandard module")
     return opts
 
 
+async def run_network(server, port, channels):
+    hash_server = hashlib.md5(server.encode("utf-8")).hexdigest()
+    dbdir = opts.dbdir + "/" + hash_server
+    while True:
+        io = None
+        session = None
+        try:
+            io = await IO.connect(server, port, opts.timeout, opts.send_rate,
+                                  opts.send_burst)
+            session = Session(io, server, opts.username, opts.nickname,
+                              channels, opts.twtfile, dbdir, opts.rmlogs,
+                              opts.markov_store, url_titles, opts.log_fsync,
+                              opts.compress_logs, opts.owner)
+            await session.loop()
+        except ExceptionForRestart:
+            plommetrics.inc("reconnects")
+        except OSError as err:
+            say("CONNECTION TO " + server + " FAILED: " + str(err))
+            await asyncio.sleep(RECONNECT_WAIT)
+        except Exception:
+
+            # Keep the other networks running, and reconnect to this one.
+            say("SESSION ON " + server + " FAILED:\n"
+                + traceback.format_exc().rstrip())
+            plommetrics.inc("session_errors")
+            await asyncio.sleep(RECONNECT_WAIT)
+        finally:
+            url_title_cache.save(True)
+            if session != None:
+                session.log.close()
+            if io != None:
+                io.close()
+
+
+async def export_metrics():
+
+    # Serve the metrics to whoever connects to the unix socket, and rewrite
+    # the metrics file every METRICS_INTERVAL seconds.
+    async def serve(reader, writer):
+        writer.write(plommetrics.registry.render().encode("utf-8"))
+        try:
+            await writer.drain()
+        except OSError:
+            pass
+        writer.close()
+
+    if opts.metrics_socket != None:
+        if os.path.exists(opts.metrics_socket):
+            os.remove(opts.metrics_socket)
+        await asyncio.start_unix_server(serve, opts.metrics_socket)
+        os.chmod(opts.metrics_socket, 0o600)
+    while opts.metrics_file != None:
+        try:
+            plommetrics.registry.write(opts.metrics_file)
+        except OSError as err:
+            say("CAN'T WRITE METRICS FILE: " + str(err))
+        await asyncio.sleep(METRICS_INTERVAL)
+
+
+async def run_networks():
+    await asyncio.gather(export_metrics(),
+                         *[run_network(server, port, channels)
+                           for server, port, channels in opts.networks])
+
+
 opts = parse_command_line_arguments()
-while True:
-    try:
-        io = IO(opts.server, opts.port, opts.timeout)
-        hash_server = hashlib.md5(opts.server.encode("utf-8")).hexdigest()
-        dbdir = opts.dbdir + "/" + hash_server
-        session = Session(io, opts.username, opts.nickname, opts.CHANNEL,
-                          opts.twtfile, dbdir, opts.rmlogs, opts.markov_store)
-        session.loop()
-    except ExceptionForRestart:
-        io.socket.close()
-        continue
+VERBOSITY = opts.verbosity
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+if not os.path.exists(opts.dbdir):
+    os.makedirs(opts.dbdir)
+url_title_cache = URLTitleCache(opts.dbdir + "/url_titles.json",
+                                opts.url_cache_size, opts.url_cache_ttl,
+                                opts.url_quiet)
+url_titles = URLTitlePool(URL_WORKERS, url_title_cache,
+                          plomfetch.Fetcher(timeout=URL_TIMEOUT))
+asyncio.run(run_networks())
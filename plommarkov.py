@@ -0,0 +1,622 @@
+#!/usr/bin/python3
+
+import mmap
+import os
+import random
+import struct
+import threading
+from array import array
+
+SENTENCE_END_MARKERS = ".!?)("
+URL_ESCAPE = "\nURL"
+URL_STARTS = ["http://", "https://", "<http://", "<https://"]
+WORD_PUNCTUATION = SENTENCE_END_MARKERS + ",;:\"'<>"
+MAX_ORDER = 5
+
+# Snapshots cover markovfeed up to a byte offset; the rest of the feed serves
+# as the append journal replayed on load. Rewrite the snapshot once that
+# journal grows beyond SNAPSHOT_JOURNAL_LIMIT bytes, in a thread of its own.
+# Only SNAPSHOT_ORDERS tables are kept in it; higher ones are rebuilt on
+# demand.
+SNAPSHOT_SUFFIX = ".snapshot"
+SNAPSHOT_MAGIC = b"PLOMMKV1"
+SNAPSHOT_ORDERS = [1, 2]
+SNAPSHOT_JOURNAL_LIMIT = 256 * 1024
+_HEADER = struct.Struct("=8sQIIIIII")
+_ORDER_HEADER = struct.Struct("=III")
+
+
+def tokenize(line):
+
+    # Lowercase incoming lines, ensure they end in a sentence end mark.
+    line = line.lower().replace("\n", "")
+    if "" == line:
+        return [], []
+    if line[-1] not in SENTENCE_END_MARKERS:
+        line += "."
+    tokens = line.split()
+
+    # Replace URLs with escape string for now, so that the Markov selector
+    # won't see them as different strings. Stash replaced URLs in urls.
+    urls = []
+    for i in range(len(tokens)):
+        for url_start in URL_STARTS:
+            if tokens[i][:len(url_start)] == url_start:
+                length = len(tokens[i])
+                if url_start[0] == "<":
+                    try:
+                        length = tokens[i].index(">") + 1
+                    except ValueError:
+                        pass
+                urls += [tokens[i][:length]]
+                tokens[i] = URL_ESCAPE + tokens[i][length:]
+                break
+    return tokens, urls
+
+
+def word_key(word):
+    # What a token or a word asked !markov about is looked up as.
+    return word.lower().strip(WORD_PUNCTUATION)
+
+
+def count_lines(lines, orders):
+
+    # Tokens, sentence starts, urls and n-gram counts of lines as add_line
+    # would add them to an empty model, in ids into a vocab of their own, for
+    # MarkovModel.merge to remap. Meant to run in worker processes.
+    vocab = []
+    ids = {}
+    tokens = array("I")
+    starts = array("I")
+    urls = []
+    for line in lines:
+        line_tokens, line_urls = tokenize(line)
+        urls += line_urls
+        for token in line_tokens:
+            position = len(tokens)
+            if position > 0 and vocab[tokens[-1]][-1] in SENTENCE_END_MARKERS:
+                starts.append(position)
+            token_id = ids.get(token)
+            if token_id is None:
+                token_id = len(vocab)
+                ids[token] = token_id
+                vocab += [token]
+            tokens.append(token_id)
+    tables = {}
+    for order in orders:
+        table = _Table()
+        for position in range(order, len(tokens)):
+            table.count(tuple(tokens[position - order:position]),
+                        tokens[position])
+        tables[order] = dict(table)
+    return vocab, tokens, starts, urls, tables
+
+
+class _Sequence:
+
+    def __init__(self, base=None):
+        if base is None:
+            base = memoryview(array("I"))
+        self.base = base
+        self.tail = array("I")
+
+    def __len__(self):
+        return len(self.base) + len(self.tail)
+
+    def __getitem__(self, key):
+        base_len = len(self.base)
+        if type(key) == slice:
+            start, stop, _ = key.indices(len(self))
+            return self.window(start, stop)
+        if key < 0:
+            key += len(self)
+        if key < base_len:
+            return self.base[key]
+        return self.tail[key - base_len]
+
+    def window(self, start, stop):
+        base_len = len(self.base)
+        if start >= base_len:
+            return self.tail[start - base_len:stop - base_len]
+        if stop <= base_len:
+            return self.base[start:stop]
+        return list(self.base[start:]) + list(self.tail[:stop - base_len])
+
+    def append(self, value):
+        self.tail.append(value)
+
+    def extend(self, values):
+        self.tail.extend(values)
+
+    def tobytes(self):
+        return self.base.tobytes() + self.tail.tobytes()
+
+
+class _Table(dict):
+
+    def count(self, context, token_id, n=1):
+        continuations = dict.get(self, context)
+        if continuations is None:
+            continuations = {}
+            self[context] = continuations
+        continuations[token_id] = continuations.get(token_id, 0) + n
+
+    def continuations(self, context):
+        return dict.get(self, context)
+
+    def merged(self):
+        return dict(self)
+
+
+class _SnapshotTable(_Table):
+
+    def __init__(self, order, contexts, offsets, token_ids, counts):
+        super().__init__()
+        self.order = order
+        self.contexts = contexts
+        self.offsets = offsets
+        self.token_ids = token_ids
+        self.counts = counts
+
+    def _base_continuations(self, i):
+        continuations = {}
+        for j in range(self.offsets[i], self.offsets[i + 1]):
+            continuations[self.token_ids[j]] = self.counts[j]
+        return continuations
+
+    def _find(self, context):
+        order = self.order
+        low = 0
+        high = len(self.offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            found = tuple(self.contexts[middle * order:(middle + 1) * order])
+            if found == context:
+                return middle
+            elif found < context:
+                low = middle + 1
+            else:
+                high = middle
+        return -1
+
+    def continuations(self, context):
+        overlay = dict.get(self, context)
+        i = self._find(context)
+        if i < 0:
+            return overlay
+        continuations = self._base_continuations(i)
+        if overlay:
+            for token_id, count in overlay.items():
+                continuations[token_id] = \
+                    continuations.get(token_id, 0) + count
+        return continuations
+
+    def merged(self):
+        order = self.order
+        merged = {}
+        for i in range(len(self.offsets) - 1):
+            context = tuple(self.contexts[i * order:(i + 1) * order])
+            merged[context] = self.continuations(context)
+        for context, continuations in self.items():
+            if context not in merged:
+                merged[context] = dict(continuations)
+        return merged
+
+
+def write_snapshot(snapshot_path, offset, vocab, tokens_bytes, starts_bytes,
+                   urls):
+
+    # Count SNAPSHOT_ORDERS anew from the tokens rather than read the live
+    # model's tables, which may change meanwhile.
+    tokens = array("I")
+    tokens.frombytes(tokens_bytes)
+    encoded = [token.encode("utf-8") for token in vocab]
+    vocab_offsets = array("I", [0])
+    for token in encoded:
+        vocab_offsets.append(vocab_offsets[-1] + len(token))
+    vocab_blob = b"".join(encoded)
+    urls_blob = "\n".join(urls).encode("utf-8")
+    order_headers = b""
+    order_sections = []
+    for order in SNAPSHOT_ORDERS:
+        table = _Table()
+        for position in range(order, len(tokens)):
+            table.count(tuple(tokens[position - order:position]),
+                        tokens[position])
+        contexts = array("I")
+        offsets = array("I", [0])
+        token_ids = array("I")
+        counts = array("I")
+
+        # Sort the contexts bucketed by their first token, and pop what's
+        # written, so that no single sort or deallocation holds the GIL for
+        # long.
+        buckets = {}
+        for context in table:
+            bucket = buckets.get(context[0])
+            if bucket is None:
+                bucket = []
+                buckets[context[0]] = bucket
+            bucket.append(context)
+        for first in sorted(buckets):
+            for context in sorted(buckets.pop(first)):
+                contexts.extend(context)
+                for token_id, count in sorted(table.pop(context).items()):
+                    token_ids.append(token_id)
+                    counts.append(count)
+                offsets.append(len(token_ids))
+        order_headers += _ORDER_HEADER.pack(order, len(offsets) - 1,
+                                            len(token_ids))
+        order_sections += [contexts.tobytes(), offsets.tobytes(),
+                           token_ids.tobytes(), counts.tobytes()]
+
+    def pad(data):
+        return data + b"\0" * (-len(data) % 4)
+
+    header = _HEADER.pack(SNAPSHOT_MAGIC, offset, len(vocab), len(vocab_blob),
+                          len(tokens), len(starts_bytes) // 4, len(urls_blob),
+                          len(SNAPSHOT_ORDERS))
+    tmp_path = snapshot_path + ".tmp"
+    f = open(tmp_path, "wb")
+    for data in [header, order_headers, vocab_offsets.tobytes(),
+                 pad(vocab_blob), tokens_bytes, starts_bytes,
+                 pad(urls_blob)] + order_sections:
+        f.write(data)
+    f.close()
+    os.replace(tmp_path, snapshot_path)
+
+
+class MarkovModel:
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = path + SNAPSHOT_SUFFIX
+        self.offset = 0
+        self.snapshot_offset = 0
+        self.vocab = []
+        self.ids = {}
+        self.tokens = _Sequence()
+        self.starts = _Sequence()
+        self.urls = []
+        self.tables = {}
+        self.backward_tables = {}
+        self.positions = None
+        self._mmap = None
+        self._saving = None
+        self._load_snapshot()
+        self.sync()
+
+    def _load_snapshot(self):
+        try:
+            f = open(self.snapshot_path, "rb")
+        except OSError:
+            return
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return
+        finally:
+            f.close()
+        view = memoryview(mapped)
+        pos = 0
+
+        def take_uints(n):
+            nonlocal pos
+            uints = view[pos:pos + 4 * n].cast("I")
+            pos += 4 * n
+            return uints
+
+        def take_bytes(n):
+            nonlocal pos
+            data = view[pos:pos + n]
+            pos += n + (-n % 4)
+            return data
+
+        try:
+            magic, offset, n_vocab, vocab_bytes, n_tokens, n_starts, \
+                urls_bytes, n_orders = _HEADER.unpack_from(view, 0)
+            pos = _HEADER.size
+            if magic != SNAPSHOT_MAGIC or \
+                    offset > os.path.getsize(self.path):
+                return
+            order_headers = []
+            for i in range(n_orders):
+                order_headers += [_ORDER_HEADER.unpack_from(view, pos)]
+                pos += _ORDER_HEADER.size
+            vocab_offsets = take_uints(n_vocab + 1)
+            vocab_blob = take_bytes(vocab_bytes)
+            vocab = []
+            for i in range(n_vocab):
+                token = vocab_blob[vocab_offsets[i]:vocab_offsets[i + 1]]
+                vocab += [str(token, "utf-8")]
+            tokens = take_uints(n_tokens)
+            starts = take_uints(n_starts)
+            urls_blob = take_bytes(urls_bytes)
+            tables = {}
+            for order, n_contexts, n_continuations in order_headers:
+                contexts = take_uints(order * n_contexts)
+                offsets = take_uints(n_contexts + 1)
+                token_ids = take_uints(n_continuations)
+                counts = take_uints(n_continuations)
+                if order in SNAPSHOT_ORDERS:
+                    tables[order] = _SnapshotTable(order, contexts, offsets,
+                                                   token_ids, counts)
+            if pos > len(view):
+                return
+        except (OSError, IndexError, struct.error, ValueError, TypeError,
+                UnicodeError):
+            return
+        self._mmap = mapped
+        self.offset = offset
+        self.snapshot_offset = offset
+        self.vocab = vocab
+        self.ids = {token: i for i, token in enumerate(vocab)}
+        self.tokens = _Sequence(tokens)
+        self.starts = _Sequence(starts)
+        self.urls = []
+        if urls_bytes > 0:
+            self.urls = str(urls_blob, "utf-8").split("\n")
+        self.tables = tables
+
+    def _frozen(self):
+        # Copies of what a snapshot of the model as of now is made of, so
+        # that writing it can go on while the model changes.
+        return (self.offset, list(self.vocab), self.tokens.tobytes(),
+                self.starts.tobytes(), list(self.urls))
+
+    def save_snapshot(self):
+        if self._saving is not None:
+            self._saving.join()
+        write_snapshot(self.snapshot_path, *self._frozen())
+        self.snapshot_offset = self.offset
+
+    def save_snapshot_in_background(self):
+        if self._saving is not None and self._saving.is_alive():
+            return
+        self._saving = threading.Thread(target=write_snapshot,
+                                        args=(self.snapshot_path,)
+                                        + self._frozen(), daemon=True)
+        self._saving.start()
+        self.snapshot_offset = self.offset
+
+    def _intern(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.vocab)
+            self.ids[token] = token_id
+            self.vocab += [token]
+        return token_id
+
+    def table(self, order):
+        table = self.tables.get(order)
+        if table is None:
+            table = _Table()
+            tokens = array("I")
+            tokens.frombytes(self.tokens.tobytes())
+            for position in range(order, len(tokens)):
+                table.count(tuple(tokens[position - order:position]),
+                            tokens[position])
+            self.tables[order] = table
+        return table
+
+    def backward_table(self, order):
+
+        # Counts of the tokens preceding each context of order tokens.
+        table = self.backward_tables.get(order)
+        if table is None:
+            table = _Table()
+            tokens = array("I")
+            tokens.frombytes(self.tokens.tobytes())
+            for position in range(len(tokens) - order):
+                table.count(tuple(tokens[position + 1:position + 1 + order]),
+                            tokens[position])
+            self.backward_tables[order] = table
+        return table
+
+    def word_positions(self):
+
+        # Positions in tokens of each word_key().
+        if self.positions is None:
+            keys = [word_key(token) for token in self.vocab]
+            positions = {}
+            tokens = array("I")
+            tokens.frombytes(self.tokens.tobytes())
+            for position, token_id in enumerate(tokens):
+                key = keys[token_id]
+                found = positions.get(key)
+                if found is None:
+                    found = array("I")
+                    positions[key] = found
+                found.append(position)
+            self.positions = positions
+        return self.positions
+
+    def add_line(self, line):
+        tokens, urls = tokenize(line)
+        self.urls += urls
+        for token in tokens:
+            position = len(self.tokens)
+            if position > 0 and \
+                    self.vocab[self.tokens[-1]][-1] in SENTENCE_END_MARKERS:
+                self.starts.append(position)
+            token_id = self._intern(token)
+            self.tokens.append(token_id)
+            for order, table in self.tables.items():
+                if position >= order:
+                    table.count(tuple(self.tokens.window(position - order,
+                                                         position)),
+                                token_id)
+            for order, table in self.backward_tables.items():
+                if position >= order:
+                    table.count(tuple(self.tokens.window(position - order + 1,
+                                                         position + 1)),
+                                self.tokens[position - order])
+            if self.positions is not None:
+                key = word_key(token)
+                if key not in self.positions:
+                    self.positions[key] = array("I")
+                self.positions[key].append(position)
+
+    def merge(self, lines, counted):
+
+        # Append lines to the feed, and their count_lines() result to the
+        # model, to the same effect as syncing after appending the lines.
+        vocab, tokens, starts, urls, tables = counted
+        self.sync()
+        if os.path.exists(self.path) and \
+                os.path.getsize(self.path) > self.offset:
+            f = open(self.path, "ab")
+            f.write(b"\n")
+            f.close()
+            self.sync()
+        for order in tables:
+            self.table(order)
+        data = "".join([line + "\n" for line in lines]).encode("utf-8")
+        f = open(self.path, "ab")
+        f.write(data)
+        f.close()
+        remap = array("I", [self._intern(token) for token in vocab])
+        offset = len(self.tokens)
+        if offset > 0 and len(tokens) > 0 and \
+                self.vocab[self.tokens[-1]][-1] in SENTENCE_END_MARKERS:
+            self.starts.append(offset)
+        self.starts.extend([offset + start for start in starts])
+        self.tokens.extend([remap[token_id] for token_id in tokens])
+        self.urls += urls
+        end = len(self.tokens)
+        for order, table in self.tables.items():
+            counts = tables.get(order, {})
+            for context, continuations in counts.items():
+                context = tuple([remap[token_id] for token_id in context])
+                for token_id, n in continuations.items():
+                    table.count(context, remap[token_id], n)
+
+            # The n-grams reaching back before the batch, or all of them for
+            # orders the batch wasn't counted for.
+            stop = end
+            if order in tables:
+                stop = min(offset + order, end)
+            for position in range(max(offset, order), stop):
+                table.count(tuple(self.tokens.window(position - order,
+                                                     position)),
+                            self.tokens[position])
+
+        # Backward tables and word positions, where already built, gain what
+        # add_line would have added for the batch.
+        for order, table in self.backward_tables.items():
+            for position in range(max(offset - order, 0), end - order):
+                table.count(tuple(self.tokens.window(position + 1,
+                                                     position + 1 + order)),
+                            self.tokens[position])
+        if self.positions is not None:
+            keys = [word_key(token) for token in vocab]
+            for position, token_id in enumerate(tokens, offset):
+                key = keys[token_id]
+                if key not in self.positions:
+                    self.positions[key] = array("I")
+                self.positions[key].append(position)
+        self.offset += len(data)
+
+    def sync(self):
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size < self.offset:
+            self.__init__(self.path)
+            return
+        if size == self.offset:
+            return
+        f = open(self.path, "rb")
+        f.seek(self.offset)
+        data = f.read(size - self.offset)
+        f.close()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].split(b"\n")[:-1]:
+            self.add_line(line.decode("utf-8", "replace"))
+        self.offset += end
+        if self.offset - self.snapshot_offset > SNAPSHOT_JOURNAL_LIMIT:
+            self.save_snapshot_in_background()
+
+    def _choose(self, table, snippets):
+
+        # Back off from the longest context known to the model, but no longer
+        # than MAX_ORDER; a context unknown at some order can't be known at
+        # any higher order either.
+        continuations = None
+        for order in range(1, min(len(snippets), MAX_ORDER) + 1):
+            found = table(order).continuations(snippets[order - 1])
+            if found is None:
+                break
+            continuations = found
+        if continuations is None:
+            return None
+        return random.choices(list(continuations),
+                              list(continuations.values()))[0]
+
+    def next_token(self, snippet):
+        token_id = self._choose(self.table, [tuple(snippet[-order:]) for order
+                                             in range(1, len(snippet) + 1)])
+        if token_id is None:
+            return random.choice(self.tokens)
+        return token_id
+
+    def about(self, word, select_length, max_length):
+
+        # Token ids of a random occurrence of word, preceded by what the
+        # backward tables suggest back to a sentence start, up to max_length
+        # characters; None if word is unknown.
+        positions = self.word_positions().get(word_key(word))
+        if not positions:
+            return None
+        snippet = [self.tokens[random.choice(positions)]]
+        length = len(self.vocab[snippet[0]])
+        while True:
+            token_id = self._choose(self.backward_table,
+                                    [tuple(snippet[:order]) for order
+                                     in range(1, min(select_length,
+                                                     len(snippet)) + 1)])
+            if token_id is None or \
+                    self.vocab[token_id][-1] in SENTENCE_END_MARKERS:
+                break
+            length += len(self.vocab[token_id]) + 1
+            if length > max_length:
+                break
+            snippet = [token_id] + snippet
+        return snippet
+
+    def generate(self, select_length, start=None):
+
+        # Start snippets with the beginning of a sentence, if possible, or
+        # with the given start token ids.
+        snippet = []
+        if start is not None:
+            for token_id in start:
+                yield self.vocab[token_id]
+            snippet = start[-select_length:]
+        elif len(self.starts) > 0:
+            position = random.choice(self.starts)
+            snippet = list(self.tokens[max(0, position - select_length):
+                                       position])
+        while True:
+            token_id = self.next_token(snippet)
+            yield self.vocab[token_id]
+            snippet = (snippet + [token_id])[-select_length:]
+
+
+_models = {}
+
+
+def get_model(path):
+    model = _models.get(path)
+    if model is None:
+        model = MarkovModel(path)
+        _models[path] = model
+    else:
+        model.sync()
+    return model
+
+
+def sync_model(path):
+    if path in _models:
+        _models[path].sync()
@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import bisect
+import contextlib
+import functools
+import os
+import threading
+import time
+
+PREFIX = "plomlombot_"
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket the q-quantile falls into.
+        seen = 0
+        for i in range(len(self.counts)):
+            seen += self.counts[i]
+            if seen > 0 and seen >= q * self.count:
+                if i < len(self.buckets):
+                    return self.buckets[i]
+                break
+        return float("inf")
+
+
+class Registry:
+
+    # Counters and latency histograms, keyed by name and sorted label items.
+    # URL title threads count too, so updates go through a lock.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self.histograms[key] = histogram
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("latency_seconds", time.perf_counter() - start,
+                         operation=operation)
+
+    def timed(self, operation):
+        def decorate(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(operation):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def value(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def labelled(self, name, label):
+        # Counter values of name by the values of one of its labels.
+        with self.lock:
+            return {dict(labels)[label]: value
+                    for (found, labels), value in self.counters.items()
+                    if found == name and label in dict(labels)}
+
+    def latencies(self):
+        with self.lock:
+            return {dict(labels).get("operation", name): histogram
+                    for (name, labels), histogram in self.histograms.items()}
+
+    def render(self):
+
+        # Prometheus text exposition format.
+        def format_labels(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if len(labels) == 0:
+                return ""
+            return "{" + str.join(",", [key + '="' + str(value).replace(
+                "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                for key, value in labels]) + "}"
+
+        lines = ["# TYPE " + PREFIX + "uptime_seconds gauge",
+                 PREFIX + "uptime_seconds " + str(time.time() - self.started)]
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines += ["# TYPE " + PREFIX + name + "_total counter"]
+                    typed.add(name)
+                lines += [PREFIX + name + "_total" + format_labels(labels)
+                          + " " + str(value)]
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines += ["# TYPE " + PREFIX + name + " histogram"]
+                    typed.add(name)
+                seen = 0
+                for i in range(len(histogram.buckets)):
+                    seen += histogram.counts[i]
+                    lines += [PREFIX + name + "_bucket" + format_labels(
+                        labels, [("le", str(histogram.buckets[i]))])
+                        + " " + str(seen)]
+                lines += [PREFIX + name + "_bucket"
+                          + format_labels(labels, [("le", "+Inf")]) + " "
+                          + str(histogram.count),
+                          PREFIX + name + "_sum" + format_labels(labels)
+                          + " " + str(histogram.sum),
+                          PREFIX + name + "_count" + format_labels(labels)
+                          + " " + str(histogram.count)]
+        return str.join("\n", lines) + "\n"
+
+    def write(self, path):
+        tmp_path = path + ".tmp"
+        f = open(tmp_path, "w")
+        f.write(self.render())
+        f.close()
+        os.replace(tmp_path, path)
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
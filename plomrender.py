@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import sys
+import irclog
+
+# Defaults, may be overwritten by command line arguments.
+SERVER = "irc.freenode.net"
+USERNAME = "plomlombot"
+NICKNAME = USERNAME
+DBDIR = os.path.expanduser("~/plomlombot_db")
+FORMAT_DIRS = {"text": "logs/", "jsonl": "jsonl_logs/"}
+FORMAT_SUFFIXES = {"text": ".txt", "jsonl": ".jsonl"}
+
+
+def render_day(raw_path, out_path, channel, nickname, username, format):
+
+    # Raw log lines read "YYYY-MM-DD HH:MM:SS UTC > LINE" for received and
+    # "YYYY-MM-DD HH:MM:SS UTC < LINE" for sent lines.
+    sent_identity = username + "@localhost"
+    n_lines = 0
+    tmp_path = out_path + ".tmp"
+    source = irclog.open_logfile(raw_path)
+    out = open(tmp_path, "w")
+    for raw_line in source:
+        raw_line = raw_line.rstrip("\n")
+        stamp = raw_line[:23]
+        direction = raw_line[24:26]
+        if len(raw_line) < 27 or direction not in {"> ", "< "}:
+            continue
+        line = irclog.Line(raw_line[26:])
+        identity = ""
+        if direction == "< ":
+            line.sender = nickname
+            identity = sent_identity
+        event = irclog.logline_event(line, channel, identity)
+        if event == None:
+            continue
+        if format == "text":
+            out.write(stamp + " " + irclog.format_event(line.sender, *event)
+                      + "\n")
+        else:
+            record = {"timestamp": stamp[:10] + "T" + stamp[11:19] + "Z",
+                      "event": event[0], "sender": line.sender,
+                      "text": event[2]}
+            if event[1] != "":
+                record["target"] = event[1]
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        n_lines += 1
+    source.close()
+    out.close()
+    os.replace(tmp_path, out_path)
+
+    # Leave the output compressed the same way the raw day file was, and drop
+    # stale renderings of the day in other compressions.
+    base_path = out_path
+    for method, suffix in irclog.COMPRESSION_SUFFIXES.items():
+        if raw_path.endswith(suffix):
+            out_path = irclog.compress_logfile(out_path, method)
+            break
+    for suffix in [""] + list(irclog.COMPRESSION_SUFFIXES.values()):
+        if base_path + suffix != out_path and \
+                os.path.exists(base_path + suffix):
+            os.remove(base_path + suffix)
+    return n_lines
+
+
+def day_tasks(opts):
+
+    # Leave out the current UTC day, whose files the bot still writes to.
+    today = datetime.datetime.utcnow().strftime("%Y-%m-%d")
+    hash_server = hashlib.md5(opts.server.encode("utf-8")).hexdigest()
+    for channel in opts.CHANNEL:
+        hash_channel = hashlib.md5(channel.encode("utf-8")).hexdigest()
+        chandir = opts.dbdir + "/" + hash_server + "/" + hash_channel + "/"
+        rawlogdir = chandir + "raw_logs/"
+        outdir = chandir + FORMAT_DIRS[opts.format]
+        if opts.outdir != None:
+            outdir = opts.outdir + "/" + hash_channel + "/"
+        if not os.path.isdir(rawlogdir):
+            print("NO RAW LOGS FOR " + channel + " IN " + rawlogdir)
+            continue
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        for f in sorted(os.listdir(rawlogdir)):
+            day = irclog.logfile_day(f)
+            if day == None or day >= today or \
+                    (opts.since != None and day < opts.since):
+                continue
+            yield (rawlogdir + f,
+                   outdir + day + FORMAT_SUFFIXES[opts.format], channel)
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description="re-render plomlombot "
+                                     "raw_logs/ day files into formatted "
+                                     "logs, except the current UTC day's")
+    parser.add_argument("-s, --server", action="store", dest="server",
+                        default=SERVER,
+                        help="server the channels' logs were kept for "
+                        "(default: " + SERVER + ")")
+    parser.add_argument("-d, --dbdir", action="store", dest="dbdir",
+                        default=DBDIR, help="directory the DB files are in")
+    parser.add_argument("-u, --username", action="store", dest="username",
+                        default=USERNAME, help="username the bot used "
+                        "(default: " + USERNAME + ")")
+    parser.add_argument("-n, --nickname", action="store", dest="nickname",
+                        default=NICKNAME, help="nickname the bot used "
+                        "(default: " + NICKNAME + ")")
+    parser.add_argument("-f, --format", action="store", dest="format",
+                        choices=list(FORMAT_DIRS), default="text",
+                        help="text, as in logs/, or jsonl, one JSON object "
+                        "per line with timestamp, event, sender, text "
+                        "(default: text)")
+    parser.add_argument("-o, --outdir", action="store", dest="outdir",
+                        default=None,
+                        help="directory to write to, into a subdirectory per "
+                        "channel (default: the channel's logs/ for text, "
+                        "jsonl_logs/ for jsonl)")
+    parser.add_argument("-S, --since", action="store", dest="since",
+                        default=None,
+                        help="only re-render days from YYYY-MM-DD on")
+    parser.add_argument("-j, --jobs", action="store", dest="jobs", type=int,
+                        default=os.cpu_count(),
+                        help="number of worker processes (default: number "
+                        "of CPUs)")
+    parser.add_argument("CHANNEL", action="store", nargs="+",
+                        help="channel(s) to re-render logs of")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opts = parse_command_line_arguments()
+    executor = concurrent.futures.ProcessPoolExecutor(max(opts.jobs, 1))
+    futures = {}
+    for raw_path, out_path, channel in day_tasks(opts):
+        future = executor.submit(render_day, raw_path, out_path, channel,
+                                 opts.nickname, opts.username, opts.format)
+        futures[future] = raw_path
+    n_lines = 0
+    failed = 0
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            n_lines += future.result()
+        except (OSError, ValueError, EOFError) as err:
+            failed += 1
+            print("RE-RENDERING " + futures[future] + " FAILED: " + str(err))
+    executor.shutdown()
+    print("RE-RENDERED " + str(len(futures) - failed) + " DAY FILES, "
+          + str(n_lines) + " LINES")
+    if failed > 0:
+        sys.exit(1)
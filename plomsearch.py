@@ -1,3 +1,12 @@
+import bisect
+import functools
+import itertools
+import operator
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class CompoundStatement:
     def __init__(self, or_list, negneg=True):
         self.or_list = or_list
@@ -200,33 +209,311 @@ def parseToCompoundStatement(string):
     strip_meta_marker(compounds)
     return toCompoundStatement(compounds)
 
-def search(query, string_list):
-
-    def testStringMatchLogic(statement, compare_value):
-        if type(statement) == str:
-            statement_true = statement in compare_value 
-        elif type(statement) == CompoundStatement:
-            or_list_true = False
-            if len(statement.or_list) > 1:
-                for i_statement in statement.or_list:
-                    if testStringMatchLogic(i_statement, compare_value):
-                        or_list_true = True
-                        break
+class SearchIndex:
+    gram_length = 3
+
+    def __init__(self, string_list=()):
+        self.lines = []
+        self.postings = {}
+        for string in string_list:
+            self.add(string)
+
+    def add(self, string):
+        i = len(self.lines)
+        self.lines += [string]
+        n = self.gram_length
+        for gram in {string[j:j + n] for j in range(len(string) - n + 1)}:
+            if gram in self.postings:
+                self.postings[gram] += [i]
             else:
-                or_list_true = testStringMatchLogic(statement.or_list[0],
-                        compare_value)
-            if statement.neg:
-                statement_true = not or_list_true
+                self.postings[gram] = [i]
+
+    def termCandidates(self, term):
+        # Superset of lines containing term, or None if term is too short.
+        n = self.gram_length
+        if len(term) < n:
+            return None
+        grams = {term[j:j + n] for j in range(len(term) - n + 1)}
+        postings = []
+        for gram in grams:
+            if gram not in self.postings:
+                return set()
+            postings += [self.postings[gram]]
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                break
+        return candidates
+
+    def candidates(self, node):
+        # Superset of lines matching compiled query node, or None if no
+        # narrowing is possible and all lines need to be tested.
+        op, operand = node
+        if op == "term":
+            return self.termCandidates(operand)
+        elif op == "not":
+            return None
+        elif op == "or":
+            union = set()
+            for i_node in operand:
+                candidates = self.candidates(i_node)
+                if candidates is None:
+                    return None
+                union |= candidates
+            return union
+        intersection = None
+        for i_node in operand:
+            candidates = self.candidates(i_node)
+            if candidates is None:
+                continue
+            if intersection is None:
+                intersection = candidates
             else:
-                statement_true = or_list_true
-        return statement_true 
-
-    results = []
-    statement = parseToCompoundStatement(query)
-    for i in range(len(string_list)):
-        if testStringMatchLogic(statement, string_list[i]):
-            results += [[i, string_list[i]]]
-    return results
+                intersection &= candidates
+            if not intersection:
+                break
+        return intersection
+
+class CompiledQuery:
+    def __init__(self, statement):
+        self.tree = simplify(toTree(statement))
+        self.source = "lambda s: " + toSource(self.tree)
+        self.match = eval(compile(self.source, "<query>", "eval"))
+
+def toTree(statement):
+    # CompoundStatement to nested ("term"|"not"|"or"|"and", operand) nodes.
+    if type(statement) == str:
+        return ("term", statement)
+    node = ("or", [toTree(i_statement) for i_statement in statement.or_list])
+    if statement.neg:
+        node = ("not", node)
+    return node
+
+def nodeCost(node):
+    op, operand = node
+    if op == "term":
+        return 1
+    elif op == "not":
+        return nodeCost(operand)
+    return sum(nodeCost(i_node) for i_node in operand)
+
+def simplify(node):
+    op, operand = node
+    if op == "term":
+        return node
+    elif op == "not":
+        operand = simplify(operand)
+        if operand[0] == "not":
+            # NOT NOT A = A
+            return operand[1]
+        if operand[0] in {"or", "and"} and \
+                any(i_node[0] == "not" for i_node in operand[1]):
+            # NOT (NOT A OR B) = A AND NOT B, NOT (NOT A AND B) = A OR NOT B
+            flipped = {"or": "and", "and": "or"}[operand[0]]
+            return simplify((flipped, [("not", i_node)
+                                       for i_node in operand[1]]))
+        return ("not", operand)
+    children = []
+    for i_node in operand:
+        i_node = simplify(i_node)
+        if i_node[0] == op:
+            children += i_node[1]
+        else:
+            children += [i_node]
+    terms = []
+    for i_node in children:
+        if i_node[0] == "term" and i_node[1] not in terms:
+            terms += [i_node[1]]
+    # A term containing another is implied by it (AND) or implies it (OR).
+    redundant = set()
+    for term in terms:
+        for other in terms:
+            if term != other and term in other:
+                redundant.add(other if op == "or" else term)
+    unique = []
+    for i_node in children:
+        if i_node[0] == "term" and i_node[1] in redundant:
+            continue
+        if i_node not in unique:
+            unique += [i_node]
+    if len(unique) == 1:
+        return unique[0]
+    unique.sort(key=nodeCost)
+    return (op, unique)
+
+def toSource(node):
+    op, operand = node
+    if op == "term":
+        return "(" + repr(operand) + " in s)"
+    elif op == "not":
+        return "(not " + toSource(operand) + ")"
+    return "(" + (" " + op + " ").join(toSource(i_node)
+                                         for i_node in operand) + ")"
+
+@functools.lru_cache(maxsize=128)
+def compileQuery(query):
+    return CompiledQuery(parseToCompoundStatement(query))
+
+class BatchCorpus:
+    # Lines joined by a separator that never occurs in search terms (the
+    # tokenizer strips it), so a term match can't span two lines.
+    separator = "\0"
+    seek_ratio = 32
+    sample_ratio = 32
+
+    def __init__(self, string_list=()):
+        self.lines = []
+        self.starts = []
+        self.length = 0
+        self._text = None
+        for string in string_list:
+            self.add(string)
+
+    def add(self, string):
+        self.lines += [string]
+        self.starts += [self.length]
+        self.length += len(string) + 1
+        self._text = None
+
+    def text(self):
+        if self._text is None:
+            self._text = self.separator.join(self.lines) + self.separator
+        return self._text
+
+    def common(self, term):
+        # Whether term occurs often enough in the first 1/sample_ratio of
+        # the joined text that testing each line beats seeking from match to
+        # match, which pays off below one match per seek_ratio lines.
+        text = self.text()
+        sample = text.count(term, 0, len(text) // self.sample_ratio)
+        return term == "" or self.sample_ratio * sample > \
+            len(self.lines) // self.seek_ratio
+
+    def seek(self, term):
+        # One byte per line, 1 where term occurs.
+        text = self.text()
+        found = bytearray(len(self.lines))
+        pos = text.find(term)
+        while pos >= 0:
+            i = bisect.bisect_right(self.starts, pos) - 1
+            found[i] = 1
+            if i + 1 == len(self.starts):
+                break
+            pos = text.find(term, self.starts[i + 1])
+        return found
+
+    def mask(self, found):
+        # found as a NumPy boolean array if available, else as an int with
+        # line i at bit 8 * i, so that &, | and ^ work bytewise.
+        if numpy is not None:
+            return numpy.frombuffer(bytes(found), dtype=bool)
+        return int.from_bytes(found, "little")
+
+    def termMask(self, term):
+        if self.common(term):
+            return self.mask(bytes(map(operator.contains, self.lines,
+                                       itertools.repeat(term))))
+        return self.mask(self.seek(term))
+
+    def matchMask(self, match):
+        return self.mask(bytes(map(match, self.lines)))
+
+    def filterMask(self, mask, match):
+        found = bytearray(len(self.lines))
+        for i in self.indices(mask):
+            if match(self.lines[i]):
+                found[i] = 1
+        return self.mask(found)
+
+    def invert(self, mask):
+        if numpy is not None:
+            return ~mask
+        return mask ^ int.from_bytes(b"\1" * len(self.lines), "little")
+
+    def indices(self, mask):
+        if numpy is not None:
+            return numpy.flatnonzero(mask).tolist()
+        return list(itertools.compress(range(len(self.lines)),
+                                       mask.to_bytes(len(self.lines),
+                                                     "little")))
+
+@functools.lru_cache(maxsize=128)
+def compileNode(node_source):
+    return eval(compile("lambda s: " + node_source, "<query>", "eval"))
+
+def searchBatch(query, string_list):
+    # Seek each distinct rare term in the joined corpus once, then combine
+    # per-term line masks bitwise along the compiled query tree. AND/OR
+    # nodes of common terms only are tested line by line in one pass.
+    corpus = string_list
+    if not isinstance(corpus, BatchCorpus):
+        corpus = BatchCorpus(string_list)
+    if isinstance(query, CompiledQuery):
+        compiled = query
+    else:
+        compiled = compileQuery(query)
+    masks = {}
+
+    def allCommon(node):
+        op, operand = node
+        if op == "term":
+            return corpus.common(operand)
+        elif op == "not":
+            return allCommon(operand)
+        return all(allCommon(i_node) for i_node in operand)
+
+    def evaluate(node):
+        op, operand = node
+        if op == "term":
+            if operand not in masks:
+                masks[operand] = corpus.termMask(operand)
+            return masks[operand]
+        elif op == "not":
+            return corpus.invert(evaluate(operand))
+        if allCommon(node):
+            return corpus.matchMask(compileNode(toSource(node)))
+        if op == "or":
+            mask = evaluate(operand[0])
+            for i_node in operand[1:]:
+                mask = mask | evaluate(i_node)
+            return mask
+
+        # Lines left by the rare parts of an AND are few enough to test the
+        # common parts on directly.
+        common = [i_node for i_node in operand if allCommon(i_node)]
+        rare = [i_node for i_node in operand if i_node not in common]
+        mask = evaluate(rare[0])
+        for i_node in rare[1:]:
+            mask = mask & evaluate(i_node)
+        if len(common) > 0:
+            node = common[0] if len(common) == 1 else ("and", common)
+            mask = corpus.filterMask(mask, compileNode(toSource(node)))
+        return mask
+
+    if allCommon(compiled.tree):
+        match = compiled.match
+        return [[i, string] for i, string in enumerate(corpus.lines)
+                if match(string)]
+    mask = evaluate(compiled.tree)
+    return [[i, corpus.lines[i]] for i in corpus.indices(mask)]
+
+def search(query, string_list, index=None, corpus=None):
+    # Queries the index can't narrow down go to searchBatch() if given a
+    # BatchCorpus of string_list.
+    compiled = compileQuery(query)
+    candidates = None
+    if index is not None:
+        candidates = index.candidates(compiled.tree)
+    if candidates is None and corpus is not None:
+        return searchBatch(compiled, corpus)
+    if candidates is None:
+        candidates = range(len(string_list))
+    else:
+        candidates = sorted(candidates)
+    match = compiled.match
+    return [[i, string_list[i]] for i in candidates if match(string_list[i])]
 
 #TEST:
 #lines = [
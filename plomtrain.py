@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import sys
+import irclog
+import plommarkov
+
+# Defaults, may be overwritten by command line arguments.
+SERVER = "irc.freenode.net"
+NICKNAME = "plomlombot"
+DBDIR = os.path.expanduser("~/plomlombot_db")
+BATCH_DAYS = 30
+
+
+def logged_messages(path, raw, channel, nickname):
+
+    # Channel messages in a day file that the bot would have fed to markov:
+    # PRIVMSGs by others, except commands. Formatted logs don't tell PRIVMSG
+    # from NOTICE, so there the bot's own lines are what gets left out.
+    f = irclog.open_logfile(path)
+    for log_line in f:
+        log_line = log_line.rstrip("\n")
+        if raw:
+            if log_line[24:26] != "> ":
+                continue
+            line = irclog.Line(log_line[26:])
+            if line.command != "PRIVMSG" or len(line.params) < 2 or \
+                    irclog.casefold(line.receiver) != irclog.casefold(channel):
+                continue
+            msg = line.params[1]
+        else:
+            if log_line[23:28] != "    <":
+                continue
+            nick, _, msg = log_line[28:].partition("> ")
+            if irclog.casefold(nick) == irclog.casefold(nickname):
+                continue
+        if msg == "" or (msg[0] == "!" and len(msg) > 1):
+            continue
+        yield msg
+    f.close()
+
+
+def count_days(paths, raw, channel, nickname, orders):
+    lines = []
+    for path in paths:
+        lines += list(logged_messages(path, raw, channel, nickname))
+    return lines, plommarkov.count_lines(lines, orders)
+
+
+def day_batches(logdir, batch_days, since, until):
+    paths = {}
+    for f in os.listdir(logdir):
+        day = irclog.logfile_day(f)
+        if day == None or (since != None and day < since) or \
+                (until != None and day > until):
+            continue
+        paths[day] = os.path.join(logdir, f)
+    days = sorted(paths)
+    return [[paths[day] for day in days[i:i + batch_days]]
+            for i in range(0, len(days), batch_days)]
+
+
+def train_channel(opts, channel, executor):
+    hash_server = hashlib.md5(opts.server.encode("utf-8")).hexdigest()
+    hash_channel = hashlib.md5(channel.encode("utf-8")).hexdigest()
+    chandir = opts.dbdir + "/" + hash_server + "/" + hash_channel + "/"
+    logdir = chandir + ("raw_logs/" if opts.raw else "logs/")
+    if not os.path.isdir(logdir):
+        print("NO LOGS FOR " + channel + " IN " + logdir)
+        return False
+    batches = day_batches(logdir, max(opts.batch_days, 1), opts.since,
+                          opts.until)
+    model = plommarkov.MarkovModel(chandir + "markovfeed")
+    orders = plommarkov.SNAPSHOT_ORDERS
+    n_lines = 0
+    futures = [executor.submit(count_days, batch, opts.raw, channel,
+                               opts.nickname, orders) for batch in batches]
+    for future in futures:
+        lines, counted = future.result()
+        model.merge(lines, counted)
+        n_lines += len(lines)
+    model.save_snapshot()
+    print("TRAINED " + channel + " ON " + str(n_lines) + " LINES FROM "
+          + str(sum([len(batch) for batch in batches])) + " DAY FILES, "
+          + str(len(model.tokens)) + " TOKENS IN TOTAL")
+    return True
+
+
+def parse_command_line_arguments():
+    parser = argparse.ArgumentParser(description="train channels' !markov "
+                                     "models on their logs; stop the bot "
+                                     "first, and mind that days trained on "
+                                     "twice count twice, as do days the bot "
+                                     "fed with --markov_store on")
+    parser.add_argument("-s, --server", action="store", dest="server",
+                        default=SERVER,
+                        help="server the channels' logs were kept for "
+                        "(default: " + SERVER + ")")
+    parser.add_argument("-d, --dbdir", action="store", dest="dbdir",
+                        default=DBDIR, help="directory the DB files are in")
+    parser.add_argument("-n, --nickname", action="store", dest="nickname",
+                        default=NICKNAME, help="nickname the bot used, whose "
+                        "lines to leave out (default: " + NICKNAME + ")")
+    parser.add_argument("-r, --raw", action="store_true", dest="raw",
+                        help="read raw_logs/ instead of logs/")
+    parser.add_argument("-S, --since", action="store", dest="since",
+                        default=None,
+                        help="only train on days from YYYY-MM-DD on")
+    parser.add_argument("-U, --until", action="store", dest="until",
+                        default=None,
+                        help="only train on days up to YYYY-MM-DD")
+    parser.add_argument("-b, --batch_days", action="store",
+                        dest="batch_days", type=int, default=BATCH_DAYS,
+                        help="day files per worker task (default: "
+                        + str(BATCH_DAYS) + ")")
+    parser.add_argument("-j, --jobs", action="store", dest="jobs", type=int,
+                        default=os.cpu_count(),
+                        help="number of worker processes (default: number "
+                        "of CPUs)")
+    parser.add_argument("CHANNEL", action="store", nargs="+",
+                        help="channel(s) to train the models of")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    opts = parse_command_line_arguments()
+    executor = concurrent.futures.ProcessPoolExecutor(max(opts.jobs, 1))
+    failed = False
+    for channel in opts.CHANNEL:
+        failed = not train_channel(opts, channel, executor) or failed
+    executor.shutdown()
+    if failed:
+        sys.exit(1)